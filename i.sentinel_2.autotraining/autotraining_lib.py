@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+#
+############################################################################
+#
+# MODULE:      i.sentinel_2.autotraining
+# AUTHOR(S):   Guido Riembauer, <riembauer at mundialis.de>
+#
+# PURPOSE:     Helper functions of i.sentinel_2.autotraining to read the
+#              input raster maps in tiles, to compute the masks and
+#              percentiles and to write the training data.
+# COPYRIGHT:   (C) 2021-2023 by mundialis GmbH & Co. KG and the GRASS
+#              Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#############################################################################
+
+import numpy as np
+
+import grass.script as grass
+from grass.pygrass.gis.region import Region
+from grass.pygrass.raster import RasterRow
+from grass.pygrass.raster.buffer import Buffer
+from grass.pygrass.vector import VectorTopo
+from grass.pygrass.vector.geometry import Point
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+# null value of CELL raster maps in the GRASS raster library
+CELL_NULL = -2147483648
+# number of rows which are processed at once
+TILE_ROWS = 512
+# number of bins of the histograms for approximate percentiles
+HISTOGRAM_BINS = 1024
+
+
+def region_shape():
+    """Function to return the number of rows and columns of the region"""
+    region = Region()
+    return (region.rows, region.cols)
+
+
+def raster_dtype(rast, byte_raster=False):
+    """Function to return the smallest numpy dtype which holds all values of
+    an open raster map exactly, uint8 only if byte_raster is set
+    """
+    rast.info.read()
+    vmin, vmax = rast.info.min, rast.info.max
+    if rast.mtype == "CELL" and vmin is not None:
+        if byte_raster and vmin >= 0 and vmax <= 255:
+            return np.uint8
+        # integers up to 2^24 are exact in float32
+        if vmin >= -(2**24) and vmax <= 2**24:
+            return np.float32
+    elif rast.mtype == "FCELL":
+        return np.float32
+    return np.float64
+
+
+def raster_range(raster):
+    """Function to return the minimum and maximum of a raster map"""
+    with RasterRow(raster) as rast:
+        rast.info.read()
+        return (rast.info.min, rast.info.max)
+
+
+def read_rows(rast, start, stop, dtype):
+    """Function to read rows of an open raster map into a numpy array, null
+    cells are set to NaN (to 0 for uint8)
+    """
+    array = np.empty((stop - start, region_shape()[1]), dtype=dtype)
+    for row_idx in range(start, stop):
+        row = rast.get_row(row_idx)
+        if dtype == np.uint8:
+            array[row_idx - start] = np.where(row == CELL_NULL, 0, row)
+        else:
+            array[row_idx - start] = row
+    if dtype != np.uint8 and rast.mtype == "CELL":
+        array[array == CELL_NULL] = np.nan
+    return array
+
+
+def read_tiles(rasters, byte_rasters):
+    """Generator to yield the row slice and a dictionary with the arrays (None
+    for empty map names) of each tile of TILE_ROWS rows. The byte_rasters are
+    read as uint8 if possible, with null as 0, which is neither a category of
+    any class nor reaches the GHS-BUILT threshold
+    """
+    opened = {}
+    try:
+        for key, raster in rasters.items():
+            if raster:
+                opened[key] = RasterRow(raster)
+                opened[key].open("r")
+        dtypes = {
+            key: raster_dtype(rast, key in byte_rasters)
+            for key, rast in opened.items()
+        }
+        n_rows = region_shape()[0]
+        for start in range(0, n_rows, TILE_ROWS):
+            stop = min(start + TILE_ROWS, n_rows)
+            tile = dict.fromkeys(rasters)
+            for key, rast in opened.items():
+                tile[key] = read_rows(rast, start, stop, dtypes[key])
+            yield slice(start, stop), tile
+    finally:
+        for rast in opened.values():
+            rast.close()
+
+
+def category_lut(cats):
+    """Function to return a boolean lookup table for the 256 values of a
+    uint8 map, True for the categories
+    """
+    lut = np.zeros(256, dtype=bool)
+    lut[cats] = True
+    return lut
+
+
+def category_mask(ref_class, cats):
+    """Function to return the mask of the cells in one of the categories"""
+    if ref_class.dtype == np.uint8:
+        # a lookup table avoids one comparison per category and cell
+        return category_lut(cats)[ref_class]
+    return np.isin(ref_class, cats)
+
+
+if njit is not None:
+    # the kernels release the GIL, so the classes still run in parallel in
+    # the thread pool; fastmath is not used as it breaks the NaN comparisons
+
+    @njit(nogil=True, cache=True)
+    def _reference_mask_kernel(
+        ref_probav, lut_probav, ref_gong, lut_gong, values, lower, upper
+    ):
+        mask = np.empty(ref_probav.shape, dtype=np.bool_)
+        for row in range(ref_probav.shape[0]):
+            for col in range(ref_probav.shape[1]):
+                mask[row, col] = (
+                    lut_probav[ref_probav[row, col]]
+                    and lut_gong[ref_gong[row, col]]
+                    and values[row, col] >= lower
+                    and values[row, col] <= upper
+                )
+        return mask
+
+    @njit(nogil=True, cache=True)
+    def _value_range_kernel(mask, values, lower, upper):
+        for row in range(mask.shape[0]):
+            for col in range(mask.shape[1]):
+                if mask[row, col]:
+                    mask[row, col] = (
+                        values[row, col] >= lower and values[row, col] <= upper
+                    )
+
+else:
+    # numpy versions of the kernels; the limits are compared as float64, as
+    # float32 values would otherwise be compared with the rounded limits
+
+    def _reference_mask_kernel(
+        ref_probav, lut_probav, ref_gong, lut_gong, values, lower, upper
+    ):
+        mask = lut_probav[ref_probav] & lut_gong[ref_gong]
+        _value_range_kernel(mask, values, lower, upper)
+        return mask
+
+    def _value_range_kernel(mask, values, lower, upper):
+        if lower > -np.inf:
+            mask &= values >= np.float64(lower)
+        if upper < np.inf:
+            mask &= values <= np.float64(upper)
+
+
+def reference_mask(
+    arrays,
+    cats_probav,
+    cats_gong=None,
+    values=None,
+    lower=-np.inf,
+    upper=np.inf,
+):
+    """Function to return the mask of cells in the given categories of the
+    reference classifications with values in the range from lower to upper
+    """
+    ref_probav = arrays["ref_class_probav"]
+    ref_gong = arrays["ref_class_gong"] if cats_gong is not None else None
+    if (
+        values is not None
+        and ref_probav.dtype == np.uint8
+        and (ref_gong is None or ref_gong.dtype == np.uint8)
+    ):
+        if ref_gong is None:
+            # every cell is accepted by the gong lookup table
+            ref_gong, cats_gong = ref_probav, np.arange(256)
+        return _reference_mask_kernel(
+            ref_probav,
+            category_lut(cats_probav),
+            ref_gong,
+            category_lut(cats_gong),
+            values,
+            float(lower),
+            float(upper),
+        )
+    mask = category_mask(ref_probav, cats_probav)
+    if ref_gong is not None:
+        mask &= category_mask(ref_gong, cats_gong)
+    if values is not None:
+        value_range_mask(mask, values, lower, upper)
+    return mask
+
+
+def value_range_mask(mask, values, lower=-np.inf, upper=np.inf):
+    """Function to remove the cells with values outside of the range from
+    lower to upper from the mask, which is changed in place and returned
+    """
+    _value_range_kernel(mask, values, float(lower), float(upper))
+    return mask
+
+
+class Histogram:
+    """Histogram of cell values with HISTOGRAM_BINS bins of equal width,
+    which is filled tile by tile and used for approximate percentiles
+    """
+
+    def __init__(self, vmin, vmax):
+        if vmin is None or vmin == vmax:
+            vmin, vmax = (vmin or 0) - 0.5, (vmin or 0) + 0.5
+        self.range = (vmin, vmax)
+        self.edges = np.linspace(vmin, vmax, HISTOGRAM_BINS + 1)
+        self.counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+        # minimum and maximum of the added values
+        self.observed = (np.inf, -np.inf)
+
+    def add(self, values):
+        """Add the cell values to the histogram, null values are ignored"""
+        values = values[~np.isnan(values)]
+        if values.size:
+            self.observed = (
+                min(self.observed[0], float(values.min())),
+                max(self.observed[1], float(values.max())),
+            )
+        self.counts += np.histogram(
+            values, bins=HISTOGRAM_BINS, range=self.range
+        )[0]
+
+    def percentile(self, percentile):
+        """Return the Xth percentile, assuming that the values are evenly
+        distributed inside each bin. The result is limited to the range of
+        the added values, so that a constant band gives its exact value
+        """
+        cumulative = np.cumsum(self.counts)
+        if cumulative[-1] == 0:
+            return np.nan
+        vmin, vmax = self.observed
+        if vmin == vmax:
+            return vmin
+        # zero-based rank of the percentile as in r.quantile
+        rank = min(percentile / 100.0 * cumulative[-1], cumulative[-1] - 1)
+        idx = int(np.searchsorted(cumulative, rank, side="right"))
+        in_bin = (rank - (cumulative[idx] - self.counts[idx]) + 0.5) / (
+            self.counts[idx]
+        )
+        value = self.edges[idx] + in_bin * (
+            self.edges[idx + 1] - self.edges[idx]
+        )
+        return min(max(value, vmin), vmax)
+
+
+def get_percentile(values, percentile):
+    """Function to return the Xth percentile of an array of cell values,
+    null values are ignored
+    """
+    return get_percentiles(values, [percentile])[percentile]
+
+
+def get_percentiles(values, percentiles):
+    """Function to return a dictionary with several percentiles of an array
+    of cell values, which are selected in one partitioning pass, or of a
+    histogram. Null values are ignored
+    """
+    if isinstance(values, Histogram):
+        results = [values.percentile(float(perc)) for perc in percentiles]
+    else:
+        # the percentiles are interpolated in float64 like in r.quantile
+        values = values[~np.isnan(values)].astype(np.float64, copy=False)
+        if values.size == 0:
+            return {percentile: np.nan for percentile in percentiles}
+        # rank rule of r.quantile: the Xth percentile is at the zero-based
+        # rank n * X / 100 (not at (n - 1) * X / 100 as in np.percentile)
+        ranks = np.array(percentiles, dtype=np.float64) / 100.0 * values.size
+        lower = np.minimum(np.floor(ranks), values.size - 1).astype(int)
+        upper = np.minimum(np.ceil(ranks), values.size - 1).astype(int)
+        values = np.partition(values, np.union1d(lower, upper))
+        results = np.where(
+            lower == upper,
+            values[lower],
+            values[lower] * (upper - ranks) + values[upper] * (ranks - lower),
+        )
+    # the percentiles are rounded to the precision reported by r.quantile,
+    # which was used before, so that the thresholds do not change
+    return {
+        percentile: round(float(result), 6)
+        for percentile, result in zip(percentiles, results)
+    }
+
+
+def row_tiles(array):
+    """Generator to split an array into tiles of TILE_ROWS rows. Yields the
+    index of the first row and the tile
+    """
+    for start in range(0, array.shape[0], TILE_ROWS):
+        rows = slice(start, start + TILE_ROWS)
+        yield start, array[rows]
+
+
+def merge_classes(class_flags, class_bits):
+    """Function to replace the bit flags of the training classes by the
+    output value of the class, class_bits is a list of the bit and the
+    output value of each class. Cells belonging to more than one class are
+    assigned to the first class in the list, cells without class are 0. The
+    array is changed in place and returned, together with the number of
+    cells of each value per tile of TILE_ROWS rows
+    """
+    tile_counts = []
+    for _start, flags in row_tiles(class_flags):
+        tile = np.zeros_like(flags)
+        for bit, value in reversed(class_bits):
+            tile[(flags & (1 << bit)) != 0] = value
+        flags[:] = tile
+        tile_counts.append(np.bincount(tile.ravel(), minlength=256))
+    return class_flags, np.array(tile_counts)
+
+
+def write_training_raster(output_raster, training):
+    """Function to write the training raster map, cells with value 0 are
+    written as null
+    """
+    n_cols = training.shape[1]
+    with RasterRow(
+        output_raster, mode="w", mtype="CELL", overwrite=grass.overwrite()
+    ) as out:
+        for _start, tile in row_tiles(training):
+            tile = np.where(tile == 0, CELL_NULL, tile.astype(np.int32))
+            for row in tile:
+                buffer = Buffer((n_cols,), mtype="CELL")
+                buffer[:] = row
+                out.put_row(buffer)
+
+
+def sample_cells(training, tile_counts, class_values, npoints):
+    """Function to draw up to npoints random cells of each class from the
+    training array, tile_counts is the number of cells of each value per
+    tile as returned by merge_classes. Returns a dictionary with the flat
+    indices of the cells of each class value
+    """
+    rng = np.random.default_rng()
+    counts = tile_counts.sum(axis=0)
+    # offsets of the tiles in the cells of each value
+    tile_offsets = np.cumsum(tile_counts, axis=0) - tile_counts
+    cells = {value: [] for value in class_values}
+    for value in class_values:
+        # draw the ranks of the sampled cells among the cells of the class,
+        # only the tiles that contain sampled cells are searched
+        ranks = np.sort(
+            rng.choice(
+                counts[value], min(npoints, counts[value]), replace=False
+            )
+        )
+        rank_tiles = (
+            np.searchsorted(tile_offsets[:, value], ranks, side="right") - 1
+        )
+        for tile_idx in np.unique(rank_tiles):
+            start = tile_idx * TILE_ROWS
+            rows = slice(start, start + TILE_ROWS)
+            idx = np.flatnonzero(training[rows].ravel() == value)
+            tile_ranks = (
+                ranks[rank_tiles == tile_idx] - tile_offsets[tile_idx, value]
+            )
+            cells[value].append(start * training.shape[1] + idx[tile_ranks])
+    return {
+        value: (
+            np.concatenate(cells[value])
+            if cells[value]
+            else np.array([], dtype=np.int64)
+        )
+        for value in class_values
+    }
+
+
+def write_training_points(
+    output_vector, cells, output_classes, int_column, str_column
+):
+    """Function to write the sampled cells as points of the output vector
+    map, with the class value and name as attributes
+    """
+    region = Region()
+    tab_cols = [
+        ("cat", "INTEGER PRIMARY KEY"),
+        (int_column, "INTEGER"),
+        (str_column, "VARCHAR(25)"),
+    ]
+    with VectorTopo(
+        output_vector, mode="w", tab_cols=tab_cols, overwrite=grass.overwrite()
+    ) as out:
+        for out_class in output_classes:
+            rows, cols = np.divmod(cells[int(out_class[0])], region.cols)
+            # points are placed at the cell centers
+            easts = region.west + (cols + 0.5) * region.ewres
+            norths = region.north - (rows + 0.5) * region.nsres
+            for east, north in zip(easts, norths):
+                out.write(
+                    Point(east, north),
+                    attrs=(int(out_class[0]), out_class[1]),
+                )
+        out.table.conn.commit()
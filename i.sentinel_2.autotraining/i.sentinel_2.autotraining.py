@@ -142,330 +142,431 @@
 # % label: Number of sampling points per class in the output vector map
 # %end
 
-import atexit
-import os
+# %option G_OPT_M_NPROCS
+# % description: Number of cores for multiprocessing, -2 is n_cores-1
+# % answer: -2
+# %end
 
-import grass.script as grass
+# %flag
+# % key: a
+# % description: Compute the percentiles approximately from histograms, which needs less memory for large regions
+# %end
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing as mp
 
-rm_rasters = []
-TMP_MASK_OLD = None
-
-
-def cleanup():
-    """Cleaning up"""
-    nulldev = open(os.devnull, "w")
-    kwargs = {"flags": "f", "quiet": True, "stderr": nulldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
-    # remove possible masks
-    if grass.find_file(name="MASK", element="raster")["file"]:
-        grass.run_command("r.mask", flags="r")
-    # reactivate potential old mask
-    if TMP_MASK_OLD:
-        grass.run_command("r.mask", raster=TMP_MASK_OLD, quiet=True)
-
-
-def test_percentage(raster, reference_cells, percentage_threshold):
-    """Test percentage of null value in raster"""
-    n_raster = int(grass.parse_command("r.univar", map=raster, flags="g")["n"])
-    if n_raster / reference_cells > percentage_threshold * 0.01:
+import numpy as np
+
+import grass.script as grass
+from grass.pygrass.utils import set_path
+
+# the helper functions are installed to etc/i.sentinel_2.autotraining
+set_path("i.sentinel_2.autotraining")
+# pylint: disable=wrong-import-position
+from autotraining_lib import (  # noqa: E402
+    Histogram,
+    get_percentile,
+    get_percentiles,
+    merge_classes,
+    raster_range,
+    read_tiles,
+    reference_mask,
+    region_shape,
+    sample_cells,
+    value_range_mask,
+    write_training_points,
+    write_training_raster,
+)
+
+# a training class has functions for its reference areas, its thresholds
+# (from the values of the bands inside the reference areas) and its areas
+TrainingClass = namedtuple(
+    "TrainingClass", ["out_class", "bands", "reference", "thresholds", "find"]
+)
+
+
+def above(threshold):
+    """Function to return the lower range limit for values greater than the
+    threshold
+    """
+    return np.nextafter(threshold, np.inf)
+
+
+def test_percentage(n_class, reference_cells, percentage_threshold):
+    """Test percentage of cells of a class"""
+    if n_class / reference_cells > percentage_threshold * 0.01:
         return True
     else:
         return False
 
 
-def get_percentile(raster, percentile):
-    """Function to return the Xth percentile of a raster"""
-    return float(
-        list(
-            (
-                grass.parse_command(
-                    "r.quantile",
-                    input=raster,
-                    percentiles=percentile,
-                    quiet=True,
-                )
-            ).keys()
-        )[0].split(":")[2]
-    )
+def water_reference(arrays):
+    """Find water reference areas"""
+    water_cats_probav = [80, 200]
+    water_cats_gong = [60]
+    return reference_mask(arrays, water_cats_probav, water_cats_gong)
 
 
-def get_or_string(raster, values):
-    """Function to generte or string"""
-    return " || ".join([f"{raster} == {value}" for value in values])
+def water_thresholds(values):
+    """Compute thresholds for water training areas"""
+    ndwi_percentile = 25
+    # ndwi_thresh_inref = '0.3'
+    # ndwi_thresh_notinref = '0.8'
+    return {"ndwi": get_percentile(values["ndwi"], ndwi_percentile)}
 
 
-def main():
-    """Main function of the module"""
-    global rm_rasters, TMP_MASK_OLD
-    ndvi = options["ndvi"]
-    ndbi = options["ndbi"]
-    ndwi = options["ndwi"]
-    bsi = options["bsi"]
-    ref_class_probav = options["ref_classification_probav"]
-    treecov = options["ref_treecover_fraction_probav"]
-    ref_class_gong = options["ref_classification_gong"]
-    ref_ghs_built = options["ref_ghs_built"]
-    percentage_threshold = float(options["percentage_threshold"])
-    output_vector = options["output_vector"]
-    output_raster = options["output_raster"]
-    npoints = options["npoints"]
-    int_column = options["int_column"]
-    str_column = options["str_column"]
+def find_water(arrays, thresholds):
+    """Find water training areas"""
+    return value_range_mask(
+        water_reference(arrays), arrays["ndwi"], lower=thresholds["ndwi"]
+    )
 
-    # output class nomenclature
-    water = ("10", "water")
-    low_veg = ("20", "low vegetation")
-    forest = ("30", "forest")
-    builtup = ("40", "built-up")
-    baresoil = ("50", "bare soil")
 
-    # classes are only kept if their possible training area covers at least
-    # <percentage_threshold>% of the total area
-    total_cells = int(
-        grass.parse_command("r.univar", map=ndvi, flags="g")["n"]
+def lowveg_reference(arrays):
+    """Find low vegetation reference areas"""
+    lowveg_cats_probav = [20, 30, 40, 100, 121, 122, 123, 124, 125, 126]
+    lowveg_cats_gong = [10, 30, 40, 50, 70]
+    treecov_max_lowveg = 25  # previously: 50
+    return reference_mask(
+        arrays,
+        lowveg_cats_probav,
+        lowveg_cats_gong,
+        values=arrays["treecov"],
+        upper=treecov_max_lowveg,
     )
-    output_classes = []
-    training_rasters = []
-
-    # find water training areas
-    grass.message(_("Checking for water areas..."))
-    water_cats_probav = ["80", "200"]
-    water_cats_gong = ["60"]
-    ndwi_percentile = "25"
-    both_class_water = f"both_classifications_water_{os.getpid()}"
-    rm_rasters.append(both_class_water)
-    if ref_class_gong:
-        exp_water1 = (
-            f"{both_class_water} = if(("
-            f"{get_or_string(ref_class_probav, water_cats_probav)}) && "
-            f"{get_or_string(ref_class_gong, water_cats_gong)},1,null())"
-        )
-    else:
-        exp_water1 = (
-            f"{both_class_water} = if(("
-            f"{get_or_string(ref_class_probav, water_cats_probav)}),1,null())"
-        )
 
-    grass.run_command("r.mapcalc", expression=exp_water1, quiet=True)
-    grass.run_command("r.mask", raster=both_class_water, quiet=True)
-    water_ndwi_perc = get_percentile(ndwi, ndwi_percentile)
-    # ndwi_thresh_inref = '0.3'
-    # ndwi_thresh_notinref = '0.8'
-    water_raster = f"water_raster_{os.getpid()}"
-    rm_rasters.append(water_raster)
-    water_exp = (
-        f"{water_raster} = if({ndwi} >= {water_ndwi_perc}, {water[0]}, null())"
-    )
-    grass.run_command("r.mapcalc", expression=water_exp, quiet=True)
-    grass.run_command("r.mask", flags="r", quiet=True)
-    if test_percentage(water_raster, total_cells, percentage_threshold):
-        output_classes.append(water)
-        training_rasters.append(water_raster)
-
-    # find low vegetation training areas
-    grass.message(_("Checking for low vegetation areas..."))
-    lowveg_cats_probav = [
-        "20",
-        "30",
-        "40",
-        "100",
-        "121",
-        "122",
-        "123",
-        "124",
-        "125",
-        "126",
-    ]
-    lowveg_cats_gong = ["10", "30", "40", "50", "70"]
+
+def lowveg_thresholds(values):
+    """Compute thresholds for low vegetation training areas"""
     ndvi_thresh_lowveg = 0.5
-    treecov_max_lowveg = "25"  # previously: 50
     # ndvi_percentile_lowveg = '50'  # previously: 50
-    tmp_lowveg_raster = f"lowveg_class_raster_{os.getpid()}"
-    rm_rasters.append(tmp_lowveg_raster)
-    if ref_class_gong:
-        exp_lowveg1 = (
-            f"{tmp_lowveg_raster} = if(("
-            f"{get_or_string(ref_class_probav, lowveg_cats_probav)}) && ("
-            f"{get_or_string(ref_class_gong, lowveg_cats_gong)}),1,0)"
-        )
-    else:
-        exp_lowveg1 = (
-            f"{tmp_lowveg_raster} = if(("
-            f"{get_or_string(ref_class_probav, lowveg_cats_probav)}),1,0)"
-        )
-    grass.run_command("r.mapcalc", expression=exp_lowveg1, quiet=True)
-    lowveg_mask_raster = f"lowveg_mask_raster_{os.getpid()}"
-    rm_rasters.append(lowveg_mask_raster)
-    eq_lowveg2 = (
-        f"{lowveg_mask_raster} = if({tmp_lowveg_raster} == 1 && {treecov} <= "
-        f"{treecov_max_lowveg},1,null())"
-    )
-    grass.run_command("r.mapcalc", expression=eq_lowveg2, quiet=True)
-    grass.run_command("r.mask", raster=lowveg_mask_raster, quiet=True)
-    lowveg_ndvi_median = get_percentile(ndvi, 50)
+    # all percentiles that may be needed are computed at once
+    ndvi_lowveg_percs = get_percentiles(values["ndvi"], [25, 50, 75])
+    lowveg_ndvi_median = ndvi_lowveg_percs[50]
     if lowveg_ndvi_median > ndvi_thresh_lowveg:
         # in this case we can assume that mask contains a lot of vegetation
         # so we can set the threshold loosely
-        ndvi_percentile_lowveg = "25"
+        ndvi_percentile_lowveg = 25
     else:
         # in this case we can assume that the mask does not actually contain
         # a major part of vegetation, so we have to set a strict threshold
-        ndvi_percentile_lowveg = "75"
-    lowveg_ndvi_perc = get_percentile(ndvi, ndvi_percentile_lowveg)
-    lowveg_raster = f"lowveg_raster_{os.getpid()}"
-    rm_rasters.append(lowveg_raster)
-    eq_lowveg3 = (
-        f"{lowveg_raster} = if({ndvi} > {lowveg_ndvi_perc},"
-        f"{low_veg[0]},null())"
+        ndvi_percentile_lowveg = 75
+    return {"ndvi": ndvi_lowveg_percs[ndvi_percentile_lowveg]}
+
+
+def find_lowveg(arrays, thresholds):
+    """Find low vegetation training areas"""
+    return value_range_mask(
+        lowveg_reference(arrays),
+        arrays["ndvi"],
+        lower=above(thresholds["ndvi"]),
     )
-    grass.run_command("r.mapcalc", expression=eq_lowveg3, quiet=True)
-    grass.run_command("r.mask", flags="r", quiet=True)
-    if test_percentage(lowveg_raster, total_cells, percentage_threshold):
-        output_classes.append(low_veg)
-        training_rasters.append(lowveg_raster)
 
-    # find forest training areas
 
-    grass.message(_("Checking for forest areas..."))
+def forest_reference(arrays):
+    """Find forest reference areas"""
     forest_cats_probav = [
-        "111",
-        "113",
-        "112",
-        "114",
-        "115",
-        "116",
-        "121",
-        "123",
-        "122",
-        "124",
-        "125",
-        "126",
+        111,
+        113,
+        112,
+        114,
+        115,
+        116,
+        121,
+        123,
+        122,
+        124,
+        125,
+        126,
     ]
-    forest_cats_gong = ["20"]
-    treecov_min_forest = "60"  # previously: 75
-    ndvi_percentile_forest = "25"
-    tmp_forest_raster = f"forest_class_raster_{os.getpid()}"
-    rm_rasters.append(tmp_forest_raster)
-    if ref_class_gong:
-        exp_forest1 = (
-            f"{tmp_forest_raster} = if(("
-            f"{get_or_string(ref_class_probav, forest_cats_probav)}) && ("
-            f"{get_or_string(ref_class_gong, forest_cats_gong)}),1,0)"
-        )
-    else:
-        exp_forest1 = (
-            f"{tmp_forest_raster} = if(("
-            f"{get_or_string(ref_class_probav, forest_cats_probav)}),1,0)"
-        )
-    grass.run_command("r.mapcalc", expression=exp_forest1, quiet=True)
-    forest_mask_raster = f"forest_mask_raster_{os.getpid()}"
-    rm_rasters.append(forest_mask_raster)
-    eq_forest2 = (
-        f"{forest_mask_raster} = if({tmp_forest_raster} == 1 && "
-        f"{treecov} >= {treecov_min_forest},1,null())"
+    forest_cats_gong = [20]
+    treecov_min_forest = 60  # previously: 75
+    return reference_mask(
+        arrays,
+        forest_cats_probav,
+        forest_cats_gong,
+        values=arrays["treecov"],
+        lower=treecov_min_forest,
     )
-    grass.run_command("r.mapcalc", expression=eq_forest2, quiet=True)
-    grass.run_command("r.mask", raster=forest_mask_raster, quiet=True)
-    forest_ndvi_perc = get_percentile(ndvi, ndvi_percentile_forest)
-    forest_raster = f"forest_raster_{os.getpid()}"
-    rm_rasters.append(forest_raster)
-    eq_forest3 = (
-        f"{forest_raster} = if({ndvi} > {forest_ndvi_perc},{forest[0]},null())"
+
+
+def forest_thresholds(values):
+    """Compute thresholds for forest training areas"""
+    ndvi_percentile_forest = 25
+    return {"ndvi": get_percentile(values["ndvi"], ndvi_percentile_forest)}
+
+
+def find_forest(arrays, thresholds):
+    """Find forest training areas"""
+    return value_range_mask(
+        forest_reference(arrays),
+        arrays["ndvi"],
+        lower=above(thresholds["ndvi"]),
     )
-    grass.run_command("r.mapcalc", expression=eq_forest3, quiet=True)
-    grass.run_command("r.mask", flags="r", quiet=True)
-    if test_percentage(forest_raster, total_cells, percentage_threshold):
-        output_classes.append(forest)
-        training_rasters.append(forest_raster)
-
-    # find bare soil training areas
-    grass.message(_("Checking for bare soil areas..."))
+
+
+def baresoil_reference(arrays):
+    """Find bare soil reference areas"""
     # bare soil can also be part of low vegetation classes - we need to verify
     # later that training pixels don't mix
+    baresoil_cats_probav = [60, 40]
+    baresoil_cats_gong = [10, 90]
+    treecov_max_baresoil = 25  # previously: 50
+    return reference_mask(
+        arrays,
+        baresoil_cats_probav,
+        baresoil_cats_gong,
+        values=arrays["treecov"],
+        upper=treecov_max_baresoil,
+    )
+
 
-    baresoil_cats_probav = ["60", "40"]
-    baresoil_cats_gong = ["10", "90"]
-    treecov_max_baresoil = "25"  # previously: 50
+def baresoil_thresholds(values):
+    """Compute thresholds for bare soil training areas"""
     ndvi_threshold_baresoil = 0.3
     # ndvi_percentile_baresoil = '75'  # previously: 25, then 50/75
-    bsi_percentile_baresoil = "25"  # previously: 75'
-
-    tmp_baresoil_raster = f"baresoil_class_raster_{os.getpid()}"
-    rm_rasters.append(tmp_baresoil_raster)
-    if ref_class_gong:
-        exp_baresoil1 = (
-            f"{tmp_baresoil_raster} = if(("
-            f"{get_or_string(ref_class_probav, baresoil_cats_probav)}) && ("
-            f"{get_or_string(ref_class_gong, baresoil_cats_gong)}),1,0)"
-        )
-    else:
-        exp_baresoil1 = (
-            f"{tmp_baresoil_raster} = if(("
-            f"{get_or_string(ref_class_probav, baresoil_cats_probav)}),1,0)"
-        )
-    grass.run_command("r.mapcalc", expression=exp_baresoil1, quiet=True)
-    baresoil_mask_raster = f"baresoil_mask_raster_{os.getpid()}"
-    rm_rasters.append(baresoil_mask_raster)
-    eq_baresoil2 = (
-        f"{baresoil_mask_raster} = if({tmp_baresoil_raster} == 1 && "
-        f"{treecov} <= {treecov_max_baresoil},1,null())"
-    )
-    grass.run_command("r.mapcalc", expression=eq_baresoil2, quiet=True)
-    grass.run_command("r.mask", raster=baresoil_mask_raster, quiet=True)
-    baresoil_ndvi_median = get_percentile(ndvi, "50")
+    bsi_percentile_baresoil = 25  # previously: 75'
+    # all percentiles that may be needed are computed at once
+    ndvi_baresoil_percs = get_percentiles(values["ndvi"], [25, 50, 75])
+    baresoil_ndvi_median = ndvi_baresoil_percs[50]
     if baresoil_ndvi_median < ndvi_threshold_baresoil:
         # in this case we can assume that a lot of the masked area is actually
         # bare soil, so we can set the threshold loosely
-        ndvi_percentile_baresoil = "75"
+        ndvi_percentile_baresoil = 75
     else:
         # here we can assume that there is some substantial part of vegetation
         # in the mask, so we have to set the threshold strict
-        ndvi_percentile_baresoil = "25"
-    baresoil_ndvi_perc = get_percentile(ndvi, ndvi_percentile_baresoil)
-    baresoil_bsi_perc = get_percentile(bsi, bsi_percentile_baresoil)
-    baresoil_raster = f"baresoil_raster_{os.getpid()}"
-    rm_rasters.append(baresoil_raster)
-    eq_baresoil3 = (
-        f"{baresoil_raster} = if({bsi} >= {baresoil_bsi_perc} && "
-        f"{ndvi} <= {baresoil_ndvi_perc},{baresoil[0]},null())"
+        ndvi_percentile_baresoil = 25
+    return {
+        "ndvi": ndvi_baresoil_percs[ndvi_percentile_baresoil],
+        "bsi": get_percentile(values["bsi"], bsi_percentile_baresoil),
+    }
+
+
+def find_baresoil(arrays, thresholds):
+    """Find bare soil training areas"""
+    baresoil_mask = baresoil_reference(arrays)
+    value_range_mask(baresoil_mask, arrays["bsi"], lower=thresholds["bsi"])
+    return value_range_mask(
+        baresoil_mask, arrays["ndvi"], upper=thresholds["ndvi"]
     )
-    grass.run_command("r.mapcalc", expression=eq_baresoil3, quiet=True)
-    grass.run_command("r.mask", flags="r", quiet=True)
-    if test_percentage(baresoil_raster, total_cells, percentage_threshold):
-        output_classes.append(baresoil)
-        training_rasters.append(baresoil_raster)
-
-    # find built-up training areas
-    grass.message(_("Checking for built-up areas..."))
-    builtup_cats_probav = ["50"]
-    # builtup_cats_gong = ["80"]
-    builtup_thresh_ghs = "3"
-    ndvi_percentile_builtup = "50"  # previously: 50, then 50
-    ndbi_percentile_builtup = "50"  # previously: 75, then 50
-    bu_mask_raster = f"builtup_mask_raster_{os.getpid()}"
-    rm_rasters.append(bu_mask_raster)
-    exp_builtup1 = (
-        f"{bu_mask_raster} = if(("
-        f"{get_or_string(ref_class_probav, builtup_cats_probav)}) && "
-        f"({ref_ghs_built}>={builtup_thresh_ghs}),1,null())"
-    )
-    grass.run_command("r.mapcalc", expression=exp_builtup1, quiet=True)
-    grass.run_command("r.mask", raster=bu_mask_raster, quiet=True)
-    builtup_ndvi_perc = get_percentile(ndvi, ndvi_percentile_builtup)
-    builtup_ndbi_perc = get_percentile(ndbi, ndbi_percentile_builtup)
-    builtup_raster = f"builtup_raster_{os.getpid()}"
-    rm_rasters.append(builtup_raster)
-    eq_builtup = (
-        f"{builtup_raster} = if({ndbi} >= {builtup_ndbi_perc} && "
-        f"{ndvi} <= {builtup_ndvi_perc},{builtup[0]},null())"
+
+
+def builtup_reference(arrays):
+    """Find built-up reference areas"""
+    builtup_cats_probav = [50]
+    # builtup_cats_gong = [80]
+    builtup_thresh_ghs = 3
+    return reference_mask(
+        arrays,
+        builtup_cats_probav,
+        values=arrays["ref_ghs_built"],
+        lower=builtup_thresh_ghs,
     )
-    grass.run_command("r.mapcalc", expression=eq_builtup, quiet=True)
-    grass.run_command("r.mask", flags="r", quiet=True)
-    if test_percentage(builtup_raster, total_cells, percentage_threshold):
-        output_classes.append(builtup)
-        training_rasters.append(builtup_raster)
+
+
+def builtup_thresholds(values):
+    """Compute thresholds for built-up training areas"""
+    ndvi_percentile_builtup = 50  # previously: 50, then 50
+    ndbi_percentile_builtup = 50  # previously: 75, then 50
+    return {
+        "ndvi": get_percentile(values["ndvi"], ndvi_percentile_builtup),
+        "ndbi": get_percentile(values["ndbi"], ndbi_percentile_builtup),
+    }
+
+
+def find_builtup(arrays, thresholds):
+    """Find built-up training areas"""
+    bu_mask = builtup_reference(arrays)
+    value_range_mask(bu_mask, arrays["ndbi"], lower=thresholds["ndbi"])
+    return value_range_mask(bu_mask, arrays["ndvi"], upper=thresholds["ndvi"])
+
+
+def main():
+    """Main function of the module"""
+    percentage_threshold = float(options["percentage_threshold"])
+    output_vector = options["output_vector"]
+    output_raster = options["output_raster"]
+    npoints = options["npoints"]
+    int_column = options["int_column"]
+    str_column = options["str_column"]
+    nprocs = int(options["nprocs"])
+
+    # test nprocs settings
+    if nprocs > mp.cpu_count():
+        grass.fatal(
+            _(
+                f"Using {nprocs} parallel processes but only "
+                f"{mp.cpu_count()} CPUs available."
+            )
+        )
+    elif nprocs == -2:
+        nprocs = max(1, mp.cpu_count() - 1)
+    elif nprocs < 1:
+        grass.fatal(_(f"Invalid number of parallel processes: {nprocs}"))
+
+    # output class nomenclature
+    water = ("10", "water")
+    low_veg = ("20", "low vegetation")
+    forest = ("30", "forest")
+    builtup = ("40", "built-up")
+    baresoil = ("50", "bare soil")
+
+    # the input raster maps are read in tiles, all classes work on the same
+    # tile in memory
+    input_rasters = {
+        "ndvi": options["ndvi"],
+        "ndwi": options["ndwi"],
+        "ndbi": options["ndbi"],
+        "bsi": options["bsi"],
+        "ref_class_probav": options["ref_classification_probav"],
+        "treecov": options["ref_treecover_fraction_probav"],
+        "ref_class_gong": options["ref_classification_gong"],
+        "ref_ghs_built": options["ref_ghs_built"],
+    }
+    # the reference maps are read as uint8 if possible, a quarter of the
+    # memory of CELL and an eighth of float64
+    byte_rasters = ["ref_class_probav", "ref_class_gong", "ref_ghs_built"]
+    # the order of this list is the priority when merging
+    training_classes = [
+        TrainingClass(
+            water, ["ndwi"], water_reference, water_thresholds, find_water
+        ),
+        TrainingClass(
+            low_veg,
+            ["ndvi"],
+            lowveg_reference,
+            lowveg_thresholds,
+            find_lowveg,
+        ),
+        TrainingClass(
+            forest, ["ndvi"], forest_reference, forest_thresholds, find_forest
+        ),
+        TrainingClass(
+            baresoil,
+            ["ndvi", "bsi"],
+            baresoil_reference,
+            baresoil_thresholds,
+            find_baresoil,
+        ),
+        TrainingClass(
+            builtup,
+            ["ndvi", "ndbi"],
+            builtup_reference,
+            builtup_thresholds,
+            find_builtup,
+        ),
+    ]
+
+    # the raster maps are read in this process, as the GRASS raster library
+    # is not thread-safe; the classes only share the read-only tiles, so they
+    # are computed in parallel
+    with ThreadPoolExecutor(max_workers=nprocs) as executor:
+        # first pass: collect the input values inside the reference areas
+        grass.message(_("Reading reference areas..."))
+        total_cells = 0
+        ref_cells = [0] * len(training_classes)
+        if flags["a"]:
+            # only histograms of the input values are kept
+            band_ranges = {
+                band: raster_range(input_rasters[band])
+                for band in ["ndvi", "ndwi", "ndbi", "bsi"]
+                if input_rasters[band]
+            }
+            ref_values = [
+                {
+                    band: Histogram(*band_ranges[band])
+                    for band in training_class.bands
+                }
+                for training_class in training_classes
+            ]
+        else:
+            ref_values = [
+                {band: [] for band in training_class.bands}
+                for training_class in training_classes
+            ]
+        for _rows, tile in read_tiles(input_rasters, byte_rasters):
+            total_cells += np.count_nonzero(~np.isnan(tile["ndvi"]))
+            ref_masks = executor.map(
+                lambda training_class: training_class.reference(tile),
+                training_classes,
+            )
+            for idx, ref_mask in enumerate(ref_masks):
+                ref_cells[idx] += np.count_nonzero(ref_mask)
+                for band, band_values in ref_values[idx].items():
+                    if flags["a"]:
+                        band_values.add(tile[band][ref_mask])
+                    else:
+                        band_values.append(tile[band][ref_mask])
+
+        # the training areas are part of the reference areas, so classes
+        # whose reference areas already fail the percentage test are skipped
+        candidates = []
+        for bit, training_class in enumerate(training_classes):
+            if test_percentage(
+                ref_cells[bit], total_cells, percentage_threshold
+            ):
+                grass.message(
+                    _(f"Checking for {training_class.out_class[1]} areas...")
+                )
+                values = {
+                    band: (
+                        band_values
+                        if flags["a"]
+                        else np.concatenate(band_values)
+                    )
+                    for band, band_values in ref_values[bit].items()
+                }
+                candidates.append((bit, training_class, values))
+            else:
+                grass.verbose(
+                    _(
+                        f"Not enough reference areas for "
+                        f"<{training_class.out_class[1]}>, skipping."
+                    )
+                )
+        del ref_values
+        class_thresholds = list(
+            executor.map(
+                lambda candidate: candidate[1].thresholds(candidate[2]),
+                candidates,
+            )
+        )
+        candidates = [
+            (bit, training_class)
+            for bit, training_class, _values in candidates
+        ]
+
+        # second pass: find the training areas of the remaining classes,
+        # stored as one bit per class
+        class_flags = np.zeros(region_shape(), dtype=np.uint8)
+        class_cells = [0] * len(training_classes)
+        for rows, tile in read_tiles(input_rasters, byte_rasters):
+            class_masks = executor.map(
+                lambda candidate, thresholds: candidate[1].find(
+                    tile, thresholds
+                ),
+                candidates,
+                class_thresholds,
+            )
+            tile_flags = class_flags[rows]
+            for (bit, _training_class), class_mask in zip(
+                candidates, class_masks
+            ):
+                tile_flags[class_mask] |= 1 << bit
+                class_cells[bit] += np.count_nonzero(class_mask)
+
+    # classes are only kept if their training area covers at least
+    # <percentage_threshold>% of the total area
+    output_classes = []
+    class_bits = []
+    for bit, training_class in enumerate(training_classes):
+        if test_percentage(
+            class_cells[bit], total_cells, percentage_threshold
+        ):
+            output_classes.append(training_class.out_class)
+            class_bits.append((bit, int(training_class.out_class[0])))
 
     # merge training rasters
     classes_in_extent = [class_n[1] for class_n in output_classes]
@@ -480,88 +581,31 @@ def main():
         grass.message(
             _(f"Only found one class in region: {classes_in_extent[0]}")
         )
-        # in this case, no merging is necessary
-        grass.run_command(
-            "g.copy",
-            raster=f"{training_rasters[0]},{output_raster}",
-            quiet=True,
-        )
     else:
         grass.message(
             _(f"Merging training data for classes {classes_in_extent}")
         )
-        # make sure that pixels only belong to one class by masking
-        tr_sum = f"tr_sum_{os.getpid()}"
-        rm_rasters.append(tr_sum)
-        tr_sum_eq = f"{tr_sum} ="
-        for rast in training_rasters:
-            tr_sum_eq += f"if( isnull({rast}), 0, 1 ) +"
-        grass.run_command("r.mapcalc", expression=tr_sum_eq[:-2], quiet=True)
-        # save MASK if there is one
-        if grass.find_file(name="MASK", element="raster")["file"]:
-            TMP_MASK_OLD = f"tmp_mask_old_{os.getpid()}"
-            grass.run_command(
-                "g.rename", raster=f"MASK,{TMP_MASK_OLD}", quiet=True
-            )
-        # create mask where the pixels belong only to one class
-        tmp_mask_new = f"tmp_mask_new_{os.getpid()}"
-        rm_rasters.append(tmp_mask_new)
-        grass.run_command(
-            "r.mapcalc",
-            expression=f"{tmp_mask_new} = if({tr_sum} == 1, 1, null())",
-            quiet=True,
-        )
-        grass.run_command("r.mask", raster=tr_sum, quiet=True)
-
         # test if there are enough pixels inside the training classes
-        for rast in training_rasters:
-            r_univar = grass.parse_command("r.univar", map=rast, flags="g")
-            if int(r_univar["n"]) < int(npoints):
+        for out_class, (bit, _value) in zip(output_classes, class_bits):
+            n_class = class_cells[bit]
+            if n_class < int(npoints):
                 grass.warning(
-                    _(f"For <{rast}> only {r_univar['n']} pixels found.")
+                    _(f"For <{out_class[1]}> only {n_class} pixels found.")
                 )
-        # patch it together
-        grass.run_command(
-            "r.patch", input=training_rasters, output=output_raster, quiet=True
-        )
-        grass.run_command("r.mask", flags="r", quiet=True)
-        # reactivate mask if there was one before
-        if TMP_MASK_OLD:
-            grass.run_command("r.mask", raster=TMP_MASK_OLD, quiet=True)
+    training, tile_counts = merge_classes(class_flags, class_bits)
+    write_training_raster(output_raster, training)
 
     # extract points
-
     grass.message(_(f"Extracting {npoints} points per class..."))
-    temp_output_column = output_raster.lower()
-    # build table
-    grass.run_command(
-        "r.sample.category",
-        input=output_raster,
-        output=output_vector,
-        npoints=npoints,
-        quiet=True,
-    )
-    grass.run_command(
-        "v.db.renamecolumn",
-        map=output_vector,
-        column=f"{temp_output_column},{int_column}",
-        quiet=True,
+    cells = sample_cells(
+        training,
+        tile_counts,
+        [value for _bit, value in class_bits],
+        int(npoints),
     )
-    grass.run_command(
-        "v.db.addcolumn",
-        map=output_vector,
-        columns=f"{str_column} VARCHAR(25)",
-        quiet=True,
+    write_training_points(
+        output_vector, cells, output_classes, int_column, str_column
     )
-    for out_class in output_classes:
-        grass.run_command(
-            "v.db.update",
-            map=output_vector,
-            column=str_column,
-            where=f"{int_column} = {out_class[0]}",
-            value=out_class[1],
-            quiet=True,
-        )
 
     grass.message(_(f"Generated output training raster map <{output_raster}>"))
     grass.message(_(f"Generated output training vector map <{output_vector}>"))
@@ -569,5 +613,4 @@ def main():
 
 if __name__ == "__main__":
     options, flags = grass.parser()
-    atexit.register(cleanup)
     main()
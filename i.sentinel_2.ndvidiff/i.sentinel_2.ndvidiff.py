@@ -152,13 +152,27 @@
 # % description: Run cloud masking (and mosaicking) using t.rast.mosaic/i.sentinel.mask
 # %end
 
+# %flag
+# % key: a
+# % description: Approximate the quartiles for the NDVI loss threshold at a 4x coarser resolution (faster)
+# %end
+
+# %flag
+# % key: p
+# % description: Import and aggregate the two timesteps in parallel, sharing the processes (both run in the current mapset)
+# %end
+
 # %rules
 # % required: output_dir,ndvi_loss_map_vect,ndvi_loss_map_rast
 
 # import needed libraries
 import atexit
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import grass.script as grass
+from grass.script.task import command_info
 
 
 # initialize global variables
@@ -169,6 +183,13 @@ rm_strds_w_rasters = []
 rm_groups = []
 cur_region = ""
 
+# bands to import with t.sentinel.import, with and without cloud masking
+BAND_PATTERN_CLOUDS = "B(02_1|03_1|04_1|08_1|8A_2|11_2|12_2)0m"
+BAND_PATTERN = "B(02_1|03_1|04_1|08_1)0m"
+# factor to coarsen the region resolution by to approximate the quartiles
+# with -a, reading only every 4th cell in each direction
+APPROX_RES_FACTOR = 4
+
 
 # cleanup function (can be extended)
 def cleanup():
@@ -186,18 +207,263 @@ def cleanup():
     )
 
 
+# supports_nprocs() and tile_size() are also used by
+# i.sentinel_2.parallel.index, as each addon is installed on its own it has
+# a copy of them. Keep both copies the same.
+@lru_cache(maxsize=None)
+def supports_nprocs(module):
+    """Checks once per module if it has an nprocs parameter"""
+    params = [param["name"] for param in command_info(module)["params"]]
+    return "nprocs" in params
+
+
+def parallel_kwargs(module, nprocs):
+    """Returns the nprocs argument for modules which support it (e.g.
+    r.mapcalc and r.univar since GRASS GIS 8.4), otherwise an empty dict
+    """
+    if supports_nprocs(module):
+        return {"nprocs": nprocs}
+    return {}
+
+
+def tile_size(nprocs):
+    """Returns width and height of the tiles for r.mapcalc.tiled: one strip
+    of full rows per process, with the height aligned to 256 rows (the block
+    size of Sentinel-2 imagery)
+    """
+    region = grass.region()
+    height = max(1, math.ceil(region["rows"] / (nprocs * 256))) * 256
+    return region["cols"], height
+
+
+def run_mapcalc(expression, nprocs):
+    """Runs r.mapcalc in parallel if possible: natively if r.mapcalc
+    supports nprocs, otherwise tiled with r.mapcalc.tiled if it is installed
+    """
+    mapcalc_kwargs = parallel_kwargs("r.mapcalc", nprocs)
+    if (
+        not mapcalc_kwargs
+        and nprocs > 1
+        and grass.find_program("r.mapcalc.tiled", "--help")
+    ):
+        width, height = tile_size(nprocs)
+        grass.run_command(
+            "r.mapcalc.tiled",
+            expression=expression,
+            processes=nprocs,
+            width=width,
+            height=height,
+            quiet=True,
+        )
+    else:
+        grass.run_command(
+            "r.mapcalc", expression=expression, quiet=True, **mapcalc_kwargs
+        )
+
+
+def export_raster(rast, out_dir):
+    """Exports a raster map or group as tiled and ZSTD compressed GeoTIFF"""
+    outpath = os.path.join(out_dir, f"{rast}.tif")
+    grass.run_command(
+        "r.out.gdal",
+        input=rast,
+        output=outpath,
+        createopt=(
+            "COMPRESS=ZSTD,TILED=YES,BLOCKXSIZE=256,BLOCKYSIZE=256,"
+            "BIGTIFF=IF_SAFER"
+        ),
+        overviews=5,
+        flags="cm",
+        quiet=True,
+        overwrite=True,
+    )
+
+
+def process_timestep(x, in_dir, nprocs):
+    """Imports, cloud masks and temporally aggregates the Sentinel-2 data of
+    one timestep. Returns the name and r.mapcalc expression of the NDVI map
+    and the RGBI group (or None)
+    """
+    clouds = flags["c"]
+    if clouds:
+        pattern = BAND_PATTERN_CLOUDS
+    else:
+        pattern = BAND_PATTERN
+    # import to STRDS
+    grass.message(_(f"Importing imagery data from {in_dir}"))
+    strds_name = f"s2_timestep{x}"
+    rm_strds_w_rasters.append(strds_name)
+
+    import_kwargs = {
+        "pattern": pattern,
+        "input_dir": in_dir,
+        "nprocs": nprocs,
+        "strds_output": strds_name,
+    }
+    if options["offset"]:
+        import_kwargs["offset"] = options["offset"]
+    if clouds:
+        import_kwargs["flags"] = "c"
+        cloud_strds_sen2cor = f"{strds_name}_clouds_sen2cor"
+        import_kwargs["strds_clouds"] = cloud_strds_sen2cor
+        rm_strds_w_rasters.append(cloud_strds_sen2cor)
+    grass.run_command("t.sentinel.import", quiet=True, **import_kwargs)
+
+    if clouds:
+        cloud_strds = f"{strds_name}_clouds_rast"
+        shadow_strds = f"{strds_name}_shadows_rast"
+        rm_strds_w_rasters.append(cloud_strds)
+        rm_strds_w_rasters.append(shadow_strds)
+        grass.message(
+            _(f"Identifying clouds/shadows for S-2 data from timestep {x}")
+        )
+        grass.run_command(
+            "t.sentinel.mask",
+            input=strds_name,
+            metadata="default",
+            output_clouds=cloud_strds,
+            min_size_clouds=0.05,
+            min_size_shadows=0.05,
+            output_shadows=shadow_strds,
+            nprocs=nprocs,
+        )
+
+        # combine cloud masks from t.sentinel.mask and imported ones
+        clouds_combined = f"{cloud_strds}_combined"
+        rm_strds_w_rasters.append(clouds_combined)
+        algexpression = (
+            f"{clouds_combined} = "
+            f"if(isnull({cloud_strds}) && isnull({cloud_strds_sen2cor}),"
+            f"null(),0)"
+        )
+        grass.run_command(
+            "t.rast.algebra",
+            nprocs=nprocs,
+            basename=clouds_combined,
+            expression=algexpression,
+            flags="n",
+            overwrite=True,
+        )
+
+    # prepare and run t.rast.mosaic
+    grass.message(
+        _(f"Temporally aggregating spectral bands for time step {x}...")
+    )
+    # only list the band STRDS of this timestep
+    band_strds = [
+        item.split("@")[0]
+        for item in grass.parse_command(
+            "t.list",
+            type="strds",
+            where=f"name LIKE '{strds_name}_B%'",
+        )
+    ]
+    rm_strds_w_rasters.extend(band_strds)
+    # use only r,g,b,nir
+    rgb_nir_strds = []
+    if options["rgbi_basename"] or options["output_dir"]:
+        ref_list = ["B02", "B03", "B04", "B08"]
+    else:
+        # no need to calculate the other aggregations
+        ref_list = ["B04", "B08"]
+    # compare whole name parts, e.g. "B04" of "s2_timestep0_B04_10m"
+    ref_bands = set(ref_list)
+    for item in band_strds:
+        if ref_bands.intersection(item.split("_")):
+            rgb_nir_strds.append(item)
+    for item in rgb_nir_strds:
+        out_rast = f"{item}_aggregated"
+        if not options["rgbi_basename"]:
+            # in that case it is not needed in GRASS
+            rm_rast.append(out_rast)
+        t_rast_mosaic_kwargs = {
+            "input": item,
+            "output": out_rast,
+            "method": options[
+                "aggregation_method"
+            ],  # even if clouds are left, this should remove them
+            # (but may add shadows)
+            "granularity": "all",  # this produces a single raster
+            # instead of a strds
+            "nprocs": nprocs,
+        }
+        if "B02" in item:
+            blue_band = out_rast
+        elif "B03" in item:
+            green_band = out_rast
+        elif "B04" in item:
+            red_band = out_rast
+        elif "B08" in item:
+            nir_band = out_rast
+
+        if clouds:
+            t_rast_mosaic_kwargs["clouds"] = clouds_combined
+            t_rast_mosaic_kwargs["shadows"] = shadow_strds
+
+            if options["cloud_shadow_buffer"]:
+                t_rast_mosaic_kwargs["cloudbuffer"] = options[
+                    "cloud_shadow_buffer"
+                ]
+            t_rast_mosaic_kwargs["shadowbuffer"] = options[
+                "cloud_shadow_buffer"
+            ]
+        grass.run_command(
+            "t.rast.mosaic", overwrite=True, **t_rast_mosaic_kwargs
+        )
+
+    # create timestep group
+    if options["rgbi_basename"]:
+        timestep_group = f"{options['rgbi_basename']}_timestep{x}"
+    else:
+        timestep_group = f"rgbi_s2_timestep{x}"
+        rm_groups.append(timestep_group)
+    if options["output_dir"] or options["rgbi_basename"]:
+        timestep_group_rasters = [
+            red_band,
+            green_band,
+            blue_band,
+            nir_band,
+        ]
+        grass.run_command(
+            "i.group",
+            group=timestep_group,
+            input=timestep_group_rasters,
+            quiet=True,
+        )
+    else:
+        timestep_group = None
+
+    # NDVI is calculated together with the difference map below
+    if x == 0:
+        if options["ndvi_map_first"]:
+            ndvi_map = options["ndvi_map_first"]
+        else:
+            ndvi_map = f"{strds_name}_ndvi"
+            rm_rast.append(ndvi_map)
+    elif x == 1:
+        if options["ndvi_map_second"]:
+            ndvi_map = options["ndvi_map_second"]
+        else:
+            ndvi_map = f"{strds_name}_ndvi"
+            rm_rast.append(ndvi_map)
+    ndvi_exp = f"float({nir_band}-{red_band})/({nir_band} + {red_band})"
+    return ndvi_map, ndvi_exp, timestep_group
+
+
 def main():
     """do the work"""
     from grass_gis_helpers import general
 
     global rm_vec, rm_rast, rm_reg, rm_strds_w_rasters, rm_groups, cur_region
-    clouds = flags["c"]
 
     # check installed addons
-    general.check_installed_addon("t.sentinel.import")
-    general.check_installed_addon("t.sentinel.mask")
-    general.check_installed_addon("t.rast.mosaic")
-    general.check_installed_addon("t.rast.algebra")
+    for addon in [
+        "t.sentinel.import",
+        "t.sentinel.mask",
+        "t.rast.mosaic",
+        "t.rast.algebra",
+    ]:
+        general.check_installed_addon(addon)
 
     # check if output dir exists
     if options["output_dir"]:
@@ -213,211 +479,110 @@ def main():
     cur_region = f"cur_region_{os.getpid()}"
     rm_reg.append(cur_region)
     grass.run_command("g.region", save=cur_region)
-    rm_reg.append(cur_region)
     grass.run_command("g.region", vector=options["aoi"], res=10, flags="a")
 
+    # compress the intermediate rasters with ZSTD (also passed on to the
+    # submodules)
+    os.environ.update(
+        dict(
+            GRASS_COMPRESS_NULLS="1",
+            GRASS_COMPRESSOR="ZSTD",
+        )
+    )
+
     # check nprocs
     nprocs = general.set_nprocs(options["nprocs"])
+    mapcalc_kwargs = parallel_kwargs("r.mapcalc", nprocs)
 
     # import
     in_dir1 = options["input_dir_first"]
     in_dir2 = options["input_dir_second"]
 
     ndvi_rasters = []
+    ndvi_exps = []
     output_rasters = []
     output_groups = []
-    for x, in_dir in enumerate([in_dir1, in_dir2]):
+    # check both input directories before any import is started
+    for in_dir in [in_dir1, in_dir2]:
         if not os.path.isdir(in_dir):
             grass.fatal(_(f"Directory {in_dir} does not exist"))
-        scenes = os.listdir(in_dir)
-        s2_scenes = [
-            (
-                True
-                if scene.startswith("S2") and scene.endswith(".SAFE")
-                else False
-            )
-            for scene in scenes
-        ]
-        if False in s2_scenes:
-            if True in s2_scenes:
-                grass.fatal(_(f"Both S2 and non-S2 scenes in {in_dir}"))
-        if clouds:
-            pattern = "B(02_1|03_1|04_1|08_1|8A_2|11_2|12_2)0m"
-        else:
-            pattern = "B(02_1|03_1|04_1|08_1)0m"
-        # import to STRDS
-        grass.message(_(f"Importing imagery data from {in_dir}"))
-        strds_name = f"s2_timestep{x}"
-        rm_strds_w_rasters.append(strds_name)
-
-        import_kwargs = {
-            "pattern": pattern,
-            "input_dir": in_dir,
-            "nprocs": nprocs,
-            "strds_output": strds_name,
-        }
-        if options["offset"]:
-            import_kwargs["offset"] = options["offset"]
-        if clouds:
-            import_kwargs["flags"] = "c"
-            cloud_strds_sen2cor = f"{strds_name}_clouds_sen2cor"
-            import_kwargs["strds_clouds"] = cloud_strds_sen2cor
-            rm_strds_w_rasters.append(cloud_strds_sen2cor)
-        grass.run_command("t.sentinel.import", quiet=True, **import_kwargs)
-
-        if clouds:
-            cloud_strds = f"{strds_name}_clouds_rast"
-            shadow_strds = f"{strds_name}_shadows_rast"
-            rm_strds_w_rasters.append(cloud_strds)
-            rm_strds_w_rasters.append(shadow_strds)
-            grass.message(
-                _(f"Identifying clouds/shadows for S-2 data from timestep {x}")
-            )
-            grass.run_command(
-                "t.sentinel.mask",
-                input=strds_name,
-                metadata="default",
-                output_clouds=cloud_strds,
-                min_size_clouds=0.05,
-                min_size_shadows=0.05,
-                output_shadows=shadow_strds,
-                nprocs=nprocs,
-            )
-
-            # combine cloud masks from t.sentinel.mask and imported ones
-            clouds_combined = f"{cloud_strds}_combined"
-            rm_strds_w_rasters.append(clouds_combined)
-            algexpression = (
-                f"{clouds_combined} = "
-                f"if(isntnull({cloud_strds}),0,"
-                f"if(isntnull({cloud_strds_sen2cor}),0,null()))"
-            )
-            grass.run_command(
-                "t.rast.algebra",
-                nprocs=nprocs,
-                basename="clouds_combined",
-                expression=algexpression,
-                flags="n",
-                overwrite=True,
-            )
-
-        # prepare and run t.rast.mosaic
-        grass.message(
-            _(f"Temporally aggregating spectral bands for time step {x}...")
-        )
-        all_strds = list(grass.parse_command("t.list").keys())
-        band_strds = [
-            item.split("@")[0]
-            for item in all_strds
-            if item.startswith(f"{strds_name}_B")
-        ]
-        rm_strds_w_rasters.extend(band_strds)
-        # use only r,g,b,nir
-        rgb_nir_strds = []
-        if options["rgbi_basename"] or options["output_dir"]:
-            ref_list = ["B02", "B03", "B04", "B08"]
-        else:
-            # no need to calculate the other aggregations
-            ref_list = ["B04", "B08"]
-        for item in band_strds:
-            if any(band in item for band in ref_list):
-                rgb_nir_strds.append(item)
-        for item in rgb_nir_strds:
-            out_rast = f"{item}_aggregated"
-            if not options["rgbi_basename"]:
-                # in that case it is not needed in GRASS
-                rm_rast.append(out_rast)
-            t_rast_mosaic_kwargs = {
-                "input": item,
-                "output": out_rast,
-                "method": options[
-                    "aggregation_method"
-                ],  # even if clouds are left, this should remove them
-                # (but may add shadows)
-                "granularity": "all",  # this produces a single raster
-                # instead of a strds
-                "nprocs": nprocs,
+        # set of the S2 check results of all entries, i.e. both True and
+        # False if the directory contains S2 and non-S2 scenes
+        with os.scandir(in_dir) as entries:
+            s2_scenes = {
+                entry.name.startswith("S2") and entry.name.endswith(".SAFE")
+                for entry in entries
             }
-            if "B02" in item:
-                blue_band = out_rast
-            elif "B03" in item:
-                green_band = out_rast
-            elif "B04" in item:
-                red_band = out_rast
-            elif "B08" in item:
-                nir_band = out_rast
-
-            if clouds:
-                t_rast_mosaic_kwargs["clouds"] = clouds_combined
-                t_rast_mosaic_kwargs["shadows"] = shadow_strds
-
-                if options["cloud_shadow_buffer"]:
-                    t_rast_mosaic_kwargs["cloudbuffer"] = options[
-                        "cloud_shadow_buffer"
-                    ]
-                t_rast_mosaic_kwargs["shadowbuffer"] = options[
-                    "cloud_shadow_buffer"
-                ]
-            grass.run_command(
-                "t.rast.mosaic", overwrite=True, **t_rast_mosaic_kwargs
-            )
-
-        # create timestep group
-        if options["rgbi_basename"]:
-            timestep_group = f"{options['rgbi_basename']}_timestep{x}"
-        else:
-            timestep_group = f"rgbi_s2_timestep{x}"
-            rm_groups.append(timestep_group)
-        if options["output_dir"] or options["rgbi_basename"]:
-            timestep_group_rasters = [
-                red_band,
-                green_band,
-                blue_band,
-                nir_band,
-            ]
-            grass.run_command(
-                "i.group",
-                group=timestep_group,
-                input=timestep_group_rasters,
-                quiet=True,
+        if s2_scenes == {True, False}:
+            grass.fatal(_(f"Both S2 and non-S2 scenes in {in_dir}"))
+    if flags["p"]:
+        # the two timesteps are independent, so they are processed in
+        # parallel and share the available processes
+        with ThreadPoolExecutor(max_workers=min(2, nprocs)) as executor:
+            results = list(
+                executor.map(
+                    process_timestep,
+                    [0, 1],
+                    [in_dir1, in_dir2],
+                    [max(1, nprocs // 2)] * 2,
+                )
             )
-            output_groups.append(timestep_group)
-
-        # calculate NDVI
-        grass.message(_(f"Calculating aggregated NDVI for time step {x}..."))
-        if x == 0:
-            if options["ndvi_map_first"]:
-                ndvi_map = options["ndvi_map_first"]
-            else:
-                ndvi_map = f"{strds_name}_ndvi"
-                rm_rast.append(ndvi_map)
-        elif x == 1:
-            if options["ndvi_map_second"]:
-                ndvi_map = options["ndvi_map_second"]
-            else:
-                ndvi_map = f"{strds_name}_ndvi"
-                rm_rast.append(ndvi_map)
+    else:
+        results = [
+            process_timestep(0, in_dir1, nprocs),
+            process_timestep(1, in_dir2, nprocs),
+        ]
+    for ndvi_map, ndvi_exp, timestep_group in results:
         ndvi_rasters.append(ndvi_map)
-        ndvi_exp = (
-            f"{ndvi_map}=float({nir_band}-{red_band})/"
-            f"({nir_band} + {red_band})"
-        )
-        grass.run_command("r.mapcalc", expression=ndvi_exp, quiet=True)
+        ndvi_exps.append(ndvi_exp)
+        if timestep_group:
+            output_groups.append(timestep_group)
 
-    grass.message(_("Calculating NDVI difference and loss maps..."))
+    grass.message(_("Calculating aggregated NDVI and NDVI difference maps..."))
     if options["ndvi_diff_map"]:
         ndvi_diff_map = options["ndvi_diff_map"]
     else:
         ndvi_diff_map = f"ndvi_diff_map_{os.getpid()}"
         rm_rast.append(ndvi_diff_map)
 
-    ndvi_diff_exp = f"{ndvi_diff_map}={ndvi_rasters[1]}-{ndvi_rasters[0]}"
-    grass.run_command("r.mapcalc", expression=ndvi_diff_exp, quiet=True)
+    # both NDVI maps and their difference are written in a single
+    # r.mapcalc run, so that each aggregated band is only read once
+    mapcalc_exps = [
+        f"{ndvi_map}={ndvi_exp}"
+        for ndvi_map, ndvi_exp in zip(ndvi_rasters, ndvi_exps)
+    ]
+    mapcalc_exps.append(f"{ndvi_diff_map}=({ndvi_exps[1]})-({ndvi_exps[0]})")
+    grass.write_command(
+        "r.mapcalc",
+        file="-",
+        stdin="\n".join(mapcalc_exps),
+        quiet=True,
+        **mapcalc_kwargs,
+    )
+
+    grass.message(_("Calculating NDVI loss map..."))
 
     if options["ndvi_diff_threshold"]:
         ndvi_diff_threshold = options["ndvi_diff_threshold"]
     else:
-        qs = grass.parse_command("r.univar", flags="ge", map=ndvi_diff_map)
+        univar_kwargs = parallel_kwargs("r.univar", nprocs)
+        if flags["a"]:
+            # r.univar samples the map at the region resolution, so a
+            # coarser region reads only a subset of the cells
+            region = grass.region()
+            univar_env = os.environ.copy()
+            univar_env["GRASS_REGION"] = grass.region_env(
+                nsres=region["nsres"] * APPROX_RES_FACTOR,
+                ewres=region["ewres"] * APPROX_RES_FACTOR,
+                flags="a",
+            )
+            univar_kwargs["env"] = univar_env
+        qs = grass.parse_command(
+            "r.univar",
+            flags="ge",
+            map=ndvi_diff_map,
+            **univar_kwargs,
+        )
         q1 = float(qs["first_quartile"])
         q3 = float(qs["third_quartile"])
         ndvi_diff_threshold = q1 - 1.5 * (q3 - q1)
@@ -428,68 +593,76 @@ def main():
         ndvi_loss_map = f"ndvi_loss_map_{os.getpid()}"
         rm_rast.append(ndvi_loss_map)
 
-    grass.run_command("r.mask", vector=options["aoi"])
+    # the AOI is applied in the expression instead of a MASK, so that the
+    # loss map can also be calculated tile-wise by r.mapcalc.tiled
+    aoi_rast = f"aoi_rast_{os.getpid()}"
+    rm_rast.append(aoi_rast)
+    grass.run_command(
+        "v.to.rast",
+        input=options["aoi"],
+        output=aoi_rast,
+        type="area",
+        use="val",
+        quiet=True,
+    )
     if options["relevant_min_ndvi"]:
         loss_exp = (
-            f"{ndvi_loss_map} = if(({ndvi_diff_map}<={ndvi_diff_threshold}"
+            f"{ndvi_loss_map} = if((isntnull({aoi_rast})"
+            f" && {ndvi_diff_map}<={ndvi_diff_threshold}"
             f" && {ndvi_rasters[0]}>={options['relevant_min_ndvi']}),1,null())"
         )
     else:
         loss_exp = (
-            f"{ndvi_loss_map} = if({ndvi_diff_map}<="
-            f"{ndvi_diff_threshold},1,null())"
+            f"{ndvi_loss_map} = if((isntnull({aoi_rast})"
+            f" && {ndvi_diff_map}<={ndvi_diff_threshold}),1,null())"
         )
-    grass.run_command("r.mapcalc", expression=loss_exp, quiet=True)
+    run_mapcalc(loss_exp, nprocs)
     if options["ndvi_loss_map_vect"]:
         ndvi_loss_map_vect = options["ndvi_loss_map_vect"]
     else:
         ndvi_loss_map_vect = f"{ndvi_loss_map}_vect"
         rm_vec.append(ndvi_loss_map_vect)
 
-    ndvi_loss_map_vect_tmp = f"{ndvi_loss_map_vect}_tmp"
-    rm_vec.append(ndvi_loss_map_vect_tmp)
+    vect_input = ndvi_loss_map
+    if options["min_size"]:
+        # remove small areas in raster space, so that they are not
+        # vectorized at all (r.reclass.area expects hectares)
+        vect_input = f"{ndvi_loss_map}_min_size"
+        rm_rast.append(vect_input)
+        grass.run_command(
+            "r.reclass.area",
+            input=ndvi_loss_map,
+            output=vect_input,
+            value=float(options["min_size"]) / 10000,
+            mode="greater",
+            method="reclass",
+            quiet=True,
+        )
 
     grass.message(_("Vectorizing results..."))
     grass.run_command(
         "r.to.vect",
-        input=ndvi_loss_map,
-        output=ndvi_loss_map_vect_tmp,
+        input=vect_input,
+        output=ndvi_loss_map_vect,
         type="area",
     )
 
-    if options["min_size"]:
-        grass.run_command(
-            "v.clean",
-            input=ndvi_loss_map_vect_tmp,
-            output=ndvi_loss_map_vect,
-            tool="rmarea",
-            threshold=options["min_size"],
-        )
-    else:
-        grass.run_command(
-            "g.rename",
-            vector=f"{ndvi_loss_map_vect_tmp},{ndvi_loss_map_vect}",
-            quiet=True,
-            overwrite=True,
-        )
-
     if options["output_dir"]:
         out_dir = options["output_dir"]
         grass.message(_(f"Exporting result maps to {out_dir}"))
         output_rasters.extend(ndvi_rasters)
         output_rasters.append(ndvi_diff_map)
         output_rasters.extend(output_groups)
-        for rast in output_rasters:
-            outpath = os.path.join(out_dir, f"{rast}.tif")
-            grass.run_command(
-                "r.out.gdal",
-                input=rast,
-                output=outpath,
-                createopt="COMPRESS=LZW,TILED=YES",
-                overviews=5,
-                flags="cm",
-                quiet=True,
-                overwrite=True,
+        # the exported raster maps are clipped to the AOI polygon
+        grass.run_command("r.mask", raster=aoi_rast, quiet=True)
+        # the exports are independent of each other
+        with ThreadPoolExecutor(max_workers=nprocs) as executor:
+            list(
+                executor.map(
+                    export_raster,
+                    output_rasters,
+                    [out_dir] * len(output_rasters),
+                )
             )
         outpath_vect = os.path.join(out_dir, f"{ndvi_loss_map_vect}.gpkg")
         grass.run_command(
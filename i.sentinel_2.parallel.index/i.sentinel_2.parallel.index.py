@@ -62,8 +62,9 @@
 
 # %option G_OPT_M_DIR
 # % key: output
-# % description: Name for output index name
+# % description: Name for output index name (one per index)
 # % required: yes
+# % multiple: yes
 # % guisection: Output
 # %end
 
@@ -73,7 +74,7 @@
 # % description: Index to be calculated
 # % required: yes
 # % options: NDVI,NDWI,NDBI,BSI,asm
-# % multiple: no
+# % multiple: yes
 # %end
 
 # %option G_OPT_M_NPROCS
@@ -82,22 +83,118 @@
 # % guisection: Optional
 # %end
 
+# %flag
+# % key: i
+# % description: Use integer arithmetic for NDVI, NDWI, NDBI and BSI (faster, requires non-negative CELL input bands)
+# %end
+
+# %flag
+# % key: p
+# % description: Keep the PCA of the input bands for asm and reuse it in later runs with the same bands and region
+# %end
+
+import hashlib
+import math
 import os
 import sys
 import multiprocessing as mp
 import atexit
+from functools import lru_cache
 import grass.script as grass
+from grass.script.task import command_info
 
 rm_rasters = []
+# below this number of cells the overhead of splitting the region into
+# tiles is larger than the gain of parallel processing
+MIN_PARALLEL_CELLS = 10000000
+
+INDEX_NAMES = {
+    "NDVI": "NDVI (Normalized difference vegetation index)",
+    "NDWI": "NDWI (Normalized difference water index)",
+    "NDBI": "NDBI (Normalized difference built-up index)",
+    "BSI": "BSI (Bare soil index)",
+    "asm": "ASM (Angular Second Moment)",
+}
+# the scaled indices are round(255 * (1 + (a - b) / (a + b)) / 2), with a
+# and b the sums of the first and second list of bands
+INDEX_BANDS = {
+    "NDVI": (["nir"], ["red"]),
+    "NDWI": (["green"], ["nir"]),
+    "NDBI": (["swir"], ["nir"]),
+    "BSI": (["swir", "red"], ["nir", "blue"]),
+}
+REQUIRED_BANDS = {
+    index: first_bands + second_bands
+    for index, (first_bands, second_bands) in INDEX_BANDS.items()
+}
+REQUIRED_BANDS["asm"] = ["blue", "green", "red", "nir"]
+FORMULA = "{output} = round(255.0 * ({first}) / (({first}) + ({second})))"
+# the same with an integer division only
+INT_FORMULA = (
+    "{output} = (510 * ({first}) + ({first}) + ({second}))"
+    "/(2 * (({first}) + ({second})))"
+)
 
 
 def cleanup():
     """Cleanup files in the end"""
+    if not rm_rasters:
+        return
     nuldev = open(os.devnull, "w", encoding="utf8")
     kwargs = {"flags": "f", "quiet": True, "stderr": nuldev}
-    for rmrast in rm_rasters:
-        if grass.find_file(name=rmrast, element="raster")["file"]:
-            grass.run_command("g.remove", type="raster", name=rmrast, **kwargs)
+    # list the rasters of the mapset once instead of a lookup per raster
+    existing = set(
+        grass.read_command(
+            "g.list", type="raster", mapset=".", quiet=True
+        ).splitlines()
+    )
+    to_remove = [rmrast for rmrast in rm_rasters if rmrast in existing]
+    if to_remove:
+        # a single g.remove call for all rasters
+        grass.run_command(
+            "g.remove", type="raster", name=",".join(to_remove), **kwargs
+        )
+
+
+# tile_size() and supports_nprocs() are copied from i.sentinel_2.ndvidiff,
+# as each addon is installed on its own. Keep both copies the same.
+def tile_size(nprocs):
+    """Returns width and height of the tiles for r.mapcalc.tiled: one strip
+    of full rows per process, with the height aligned to 256 rows (the block
+    size of Sentinel-2 imagery)
+    """
+    region = grass.region()
+    height = max(1, math.ceil(region["rows"] / (nprocs * 256))) * 256
+    return region["cols"], height
+
+
+@lru_cache(maxsize=None)
+def supports_nprocs(module):
+    """Checks once per module if it has an nprocs parameter"""
+    params = [param["name"] for param in command_info(module)["params"]]
+    return "nprocs" in params
+
+
+def band_fingerprint(bands):
+    """Returns a short hash of the names and modification times of the
+    raster maps and of the current region, which changes when one of the
+    maps is overwritten or the region is changed
+    """
+    band_hash = hashlib.blake2b(digest_size=8)
+    # the PCA statistics and extent depend on the region
+    region = grass.region()
+    band_hash.update(
+        "|".join(
+            f"{key}:{region[key]}"
+            for key in ("n", "s", "e", "w", "nsres", "ewres")
+        ).encode()
+    )
+    for band in bands:
+        cell_file = grass.find_file(name=band, element="cell")["file"]
+        if not cell_file:
+            grass.fatal(_(f"Raster map <{band}> not found"))
+        band_hash.update(f"{band}:{os.path.getmtime(cell_file)}|".encode())
+    return band_hash.hexdigest()
 
 
 def main():
@@ -107,10 +204,9 @@ def main():
     green = options["green"]
     blue = options["blue"]
     nir = options["nir"]
-    swir = options["swir"]
-    index = options["index"]
+    indices = options["index"].split(",")
     nprocs = int(options["nprocs"])
-    output = options["output"]
+    outputs = options["output"].split(",")
     # set some common environmental variables, like:
     os.environ.update(
         dict(
@@ -120,121 +216,180 @@ def main():
         )
     )
 
-    if not grass.find_program("r.mapcalc.tiled", "--help"):
+    # test nprocs settings
+    cpu_count = mp.cpu_count()
+    if nprocs > cpu_count:
         grass.fatal(
             _(
-                "The 'r.mapcalc.tiled' module was not found, install it first:"
-                "\ng.extension r.mapcalc.tiled"
+                f"Using {nprocs} parallel processes but only "
+                f"{cpu_count} CPUs available."
             )
         )
+    elif nprocs == -2:
+        nprocs = max(1, cpu_count - 1)
+    region = grass.region()
+    if nprocs > 1 and region["rows"] * region["cols"] < MIN_PARALLEL_CELLS:
+        grass.verbose(_("Small region, calculating without parallelization"))
+        nprocs = 1
 
-    # test nprocs settings
-    if nprocs > mp.cpu_count():
+    # r.mapcalc.tiled is only needed for parallel processing if r.mapcalc
+    # has no nprocs parameter
+    native_nprocs = nprocs > 1 and supports_nprocs("r.mapcalc")
+    if (
+        nprocs > 1
+        and not native_nprocs
+        and any(index != "asm" for index in indices)
+        and not grass.find_program("r.mapcalc.tiled", "--help")
+    ):
         grass.fatal(
             _(
-                f"Using {nprocs} parallel processes but only "
-                f"{mp.cpu_count()} CPUs available."
+                "The 'r.mapcalc.tiled' module was not found, install it first:"
+                "\ng.extension r.mapcalc.tiled"
             )
         )
 
-    if index == "NDVI":
-        if not red and nir:
-            grass.fatal(
-                _(f"<red> and <nir> must be set for the index <{index}>")
-            )
-        grass.message(
+    # without the r.texture.tiled addon the texture is calculated serially,
+    # as the parallel processing is the default for large regions
+    texture_tiled = nprocs > 1 and "asm" in indices
+    if texture_tiled and not grass.find_program("r.texture.tiled", "--help"):
+        grass.warning(
             _(
-                "Calculation of NDVI (Normalized difference vegetation "
-                "index)..."
+                "The 'r.texture.tiled' module was not found, the texture is "
+                "calculated without parallelization. Install it with:"
+                "\ng.extension r.texture.tiled"
             )
         )
-        formula = (
-            f"{output} = round(255 * (1.0 + ({nir} - {red})/"
-            f"float(({nir} + {red})))/2.0)"
-        )
+        texture_tiled = False
 
-    elif index == "NDWI":
-        grass.message(
-            _("Calculation of NDWI (Normalized difference water index)...")
-        )
-        formula = (
-            f"{output} = round(255 * (1.0 + ({green} - {nir})/"
-            f"float(({green} + {nir})))/2.0)"
-        )
+    if len(indices) != len(outputs):
+        grass.fatal(_("The number of <index> and <output> names differ"))
 
-    elif index == "NDBI":
-        grass.message(
-            _("Calculation of NDBI (Normalized difference built-up index)...")
-        )
-        formula = (
-            f"{output} = round(255 * (1.0 + ({swir} - {nir})/"
-            f"float(({swir} + {nir})))/2.0)"
-        )
-
-    elif index == "BSI":
-        grass.message(_("Calculation of BSI (Bare soil index)..."))
-        formula = (
-            f"{output} = round(255 * (1.0 + (({swir} + {red})-({nir} + {blue}))"
-            f"/float((({swir} + {red})+({nir} + {blue}))))/2.0)"
-        )
-
-    elif index == "asm":
-        grass.message(_("Calculation of ASM (Angular Second Moment)..."))
-        # First calculate pca1 of the four 10m bands (2,3,4,8) as input
-        # for the texture calculation
-        grass.message(_("Calculating PCA"))
-        pca_name = f"pca_{os.getpid()}"
-        rm_rasters.extend(
-            [
-                pca_name + ".1",
-                pca_name + ".2",
-                pca_name + ".3",
-                pca_name + ".4",
-            ]
-        )
-        grass.run_command(
-            "i.pca", input=[blue, green, red, nir], output=pca_name, quiet=True
-        )
-        # Calculate texture - Angular Second Moment.
-        # Window Size=3 results in larger differences between
-        # urban and agricultural
-        grass.message(_("Calculating Texture"))
-        if nprocs > 1:
-            grass.run_command(
-                "r.texture.tiled",
-                input=f"{pca_name}.1",
-                method="asm",
-                processes=nprocs,
-                size=3,
-                output=output,
-                quiet=True,
-            )
-        else:
-            grass.run_command(
-                "r.texture",
-                input=f"{pca_name}.1",
-                method="asm",
-                size=3,
-                output=output,
-                quiet=True,
+    # check all indices before calculating anything, so that an invalid
+    # index does not fail the run after the others are computed
+    for index in indices:
+        if index not in INDEX_NAMES:
+            grass.fatal(
+                _(
+                    "Index not found. Please indicate one of the following:"
+                    " NDVI,NDWI,NDBI,BSI,asm"
+                )
             )
-    else:
-        grass.fatal(
-            _(
-                "Index not found. Please indicate one of the following:"
-                " NDVI,NDWI,NDBI,BSI,asm"
+        missing = [band for band in REQUIRED_BANDS[index] if not options[band]]
+        if missing:
+            grass.fatal(
+                _(
+                    f"<{'>, <'.join(missing)}> must be set for the index "
+                    f"<{index}>"
+                )
             )
+        if flags["i"] and index in INDEX_BANDS:
+            first_bands, second_bands = INDEX_BANDS[index]
+            for band in first_bands + second_bands:
+                if grass.raster_info(options[band])["datatype"] != "CELL":
+                    grass.fatal(
+                        _(
+                            f"<{options[band]}> is not of type CELL, the "
+                            "integer arithmetic can not be used"
+                        )
+                    )
+
+    # the formulas of all indices are collected first, so that they can be
+    # calculated together
+    formulas = []
+    for index, output in zip(indices, outputs):
+        grass.message(_(f"Calculation of {INDEX_NAMES[index]}..."))
+        if index == "asm":
+            # First calculate pca1 of the four 10m bands (2,3,4,8) as input
+            # for the texture calculation
+            pca_bands = [blue, green, red, nir]
+            if flags["p"]:
+                # the name only depends on the input bands, so that a PCA of
+                # a previous run can be found again
+                pca_name = f"pca_{band_fingerprint(pca_bands)}"
+            else:
+                pca_name = f"pca_{os.getpid()}"
+                rm_rasters.extend(
+                    [
+                        pca_name + ".1",
+                        pca_name + ".2",
+                        pca_name + ".3",
+                        pca_name + ".4",
+                    ]
+                )
+            if (
+                flags["p"]
+                and grass.find_file(name=f"{pca_name}.1", element="raster")[
+                    "file"
+                ]
+            ):
+                grass.message(_(f"Reusing PCA <{pca_name}>"))
+            else:
+                grass.message(_("Calculating PCA"))
+                grass.run_command(
+                    "i.pca", input=pca_bands, output=pca_name, quiet=True
+                )
+            # Calculate texture - Angular Second Moment.
+            # Window Size=3 results in larger differences between
+            # urban and agricultural
+            grass.message(_("Calculating Texture"))
+            if texture_tiled:
+                # the tiles overlap by half of the moving window
+                width, height = tile_size(nprocs)
+                grass.run_command(
+                    "r.texture.tiled",
+                    input=f"{pca_name}.1",
+                    method="asm",
+                    processes=nprocs,
+                    size=3,
+                    tile_width=width,
+                    tile_height=height,
+                    overlap=1,
+                    output=output,
+                    quiet=True,
+                )
+            else:
+                grass.run_command(
+                    "r.texture",
+                    input=f"{pca_name}.1",
+                    method="asm",
+                    size=3,
+                    output=output,
+                    quiet=True,
+                )
+            continue
+
+        # round(255 * (1 + (a - b) / (a + b)) / 2) reduced to
+        # round(255 * a / (a + b)), with fewer operations per cell
+        first_bands, second_bands = INDEX_BANDS[index]
+        first = " + ".join(options[band] for band in first_bands)
+        second = " + ".join(options[band] for band in second_bands)
+        formula = INT_FORMULA if flags["i"] else FORMULA
+        formulas.append(
+            formula.format(output=output, first=first, second=second)
         )
-    if index != "asm":
-        if nprocs > 1:
+
+    if nprocs > 1 and not native_nprocs:
+        width, height = tile_size(nprocs)
+        for formula in formulas:
             grass.run_command(
                 "r.mapcalc.tiled",
                 expression=formula,
                 processes=nprocs,
+                width=width,
+                height=height,
                 quiet=True,
             )
-        else:
-            grass.run_command("r.mapcalc", expression=formula, quiet=True)
+    elif formulas:
+        # a single r.mapcalc run reads each band only once for all indices,
+        # in parallel if r.mapcalc supports nprocs
+        mapcalc_kwargs = {"nprocs": nprocs} if native_nprocs else {}
+        grass.write_command(
+            "r.mapcalc",
+            file="-",
+            stdin="\n".join(formulas),
+            quiet=True,
+            **mapcalc_kwargs,
+        )
 
 
 if __name__ == "__main__":
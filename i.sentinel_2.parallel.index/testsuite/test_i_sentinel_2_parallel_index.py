@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#
+############################################################################
+#
+# MODULE:      i.sentinel_2.parallel.index test
+# AUTHOR(S):   Guido Riembauer, <riembauer at mundialis.de>
+#
+# PURPOSE:     Calculates different indices in parallel.
+# COPYRIGHT:   (C) 2023 by mundialis GmbH & Co. KG and the GRASS
+#              Development Team
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+#############################################################################
+
+import math
+import multiprocessing as mp
+import os
+
+from grass.gunittest.case import TestCase
+from grass.gunittest.main import test
+from grass.gunittest.gmodules import SimpleModule
+import grass.script as grass
+from grass.script.task import command_info
+
+
+class TestISentinel2ParallelIndex(TestCase):
+    """Test class for i.sentinel_2.parallel.index"""
+
+    pid_str = str(os.getpid())
+    # from the nc_spm dataset:
+    blue = "lsat7_2002_10"
+    green = "lsat7_2002_20"
+    red = "lsat7_2002_30"
+    nir = "lsat7_2002_40"
+    old_region = f"saved_region_{pid_str}"
+    # calculated from the nc_spm dataset:
+    ndvi_ref = f"ndvi_ref_{pid_str}"
+    ndwi_ref = f"ndwi_ref_{pid_str}"
+    # to be generated
+    ndvi = f"ndvi_{pid_str}"
+    ndwi = f"ndwi_{pid_str}"
+    ndvi_int = f"ndvi_int_{pid_str}"
+    asm = f"asm_{pid_str}"
+    asm_reused = f"asm_reused_{pid_str}"
+    ndvi_serial = f"ndvi_serial_{pid_str}"
+    asm_serial = f"asm_serial_{pid_str}"
+    # MIN_PARALLEL_CELLS of the module, smaller regions run without
+    # parallelization
+    min_parallel_cells = 10000000
+
+    @classmethod
+    # pylint: disable=invalid-name
+    def setUpClass(cls):
+        """Ensures expected computational region and generated data"""
+        grass.run_command("g.region", save=cls.old_region)
+        grass.run_command("g.region", raster=cls.blue)
+        cls.create_references()
+
+    @classmethod
+    def create_references(cls):
+        """Calculates the reference indices with the original formulas"""
+        # the indices scaled to 0-255, i.e. 255 * (1 + index) / 2
+        ndvi_exp = (
+            f"{cls.ndvi_ref} = round(255 * (1.0 + ({cls.nir} - {cls.red})/"
+            f"float(({cls.nir} + {cls.red})))/2.0)"
+        )
+        ndwi_exp = (
+            f"{cls.ndwi_ref} = round(255 * (1.0 + ({cls.green} - {cls.nir})/"
+            f"float(({cls.green} + {cls.nir})))/2.0)"
+        )
+        grass.write_command(
+            "r.mapcalc",
+            file="-",
+            stdin="\n".join([ndvi_exp, ndwi_exp]),
+            overwrite=True,
+        )
+
+    @classmethod
+    # pylint: disable=invalid-name
+    def tearDownClass(cls):
+        """Remove the temporary region and generated data"""
+        grass.run_command("g.region", region=cls.old_region)
+        grass.run_command(
+            "g.remove",
+            type="raster",
+            name=[cls.ndvi_ref, cls.ndwi_ref],
+            flags="f",
+        )
+
+    # pylint: disable=invalid-name
+    def tearDown(self):
+        """Remove the outputs created
+        This is executed after each test run.
+        """
+        grass.run_command(
+            "g.remove",
+            type="raster",
+            name=[
+                self.ndvi,
+                self.ndwi,
+                self.ndvi_int,
+                self.asm,
+                self.asm_reused,
+                self.ndvi_serial,
+                self.asm_serial,
+            ],
+            flags="f",
+        )
+
+    def list_pca_maps(self):
+        """Returns the names of the PCA maps in the current mapset"""
+        return {
+            name.split("@")[0]
+            for name in grass.list_strings(
+                "raster", pattern="pca_*", mapset="."
+            )
+        }
+
+    def test_multiple_indices(self):
+        """Test if several indices are calculated in one run, each written
+        to its output map
+        """
+        par_index = SimpleModule(
+            "i.sentinel_2.parallel.index",
+            red=self.red,
+            green=self.green,
+            nir=self.nir,
+            index="NDVI,NDWI",
+            output=f"{self.ndvi},{self.ndwi}",
+            nprocs=1,
+        )
+        self.assertModule(par_index)
+        # the original formulas can round to the next integer at .5, due
+        # to the floating point error of the additional operations
+        self.assertRastersNoDifference(self.ndvi, self.ndvi_ref, precision=1)
+        self.assertRastersNoDifference(self.ndwi, self.ndwi_ref, precision=1)
+
+    def test_integer_arithmetic(self):
+        """Test if the integer arithmetic (-i) gives the same result"""
+        for output, flags in ((self.ndvi, ""), (self.ndvi_int, "i")):
+            par_index = SimpleModule(
+                "i.sentinel_2.parallel.index",
+                red=self.red,
+                nir=self.nir,
+                index="NDVI",
+                output=output,
+                nprocs=1,
+                flags=flags,
+            )
+            self.assertModule(par_index)
+        self.assertRastersNoDifference(self.ndvi_int, self.ndvi, precision=0.0)
+        self.assertRastersNoDifference(
+            self.ndvi_int, self.ndvi_ref, precision=1
+        )
+
+    def test_keep_pca(self):
+        """Test if the PCA for asm is kept and reused with -p"""
+        pca_before = self.list_pca_maps()
+        asm_kwargs = {
+            "blue": self.blue,
+            "green": self.green,
+            "red": self.red,
+            "nir": self.nir,
+            "index": "asm",
+            "nprocs": 1,
+            "flags": "p",
+        }
+        try:
+            par_index = SimpleModule(
+                "i.sentinel_2.parallel.index", output=self.asm, **asm_kwargs
+            )
+            self.assertModule(par_index)
+            pca_maps = self.list_pca_maps() - pca_before
+            self.assertEqual(len(pca_maps), 4, "The PCA maps were not kept")
+            par_index = SimpleModule(
+                "i.sentinel_2.parallel.index",
+                output=self.asm_reused,
+                **asm_kwargs,
+            )
+            self.assertModule(par_index)
+            self.assertEqual(
+                self.list_pca_maps() - pca_before,
+                pca_maps,
+                "The PCA maps were not reused",
+            )
+            self.assertRastersNoDifference(
+                self.asm_reused, self.asm, precision=0.0
+            )
+        finally:
+            pca_new = self.list_pca_maps() - pca_before
+            if pca_new:
+                grass.run_command(
+                    "g.remove", type="raster", name=list(pca_new), flags="f"
+                )
+
+    def test_parallel_large_region(self):
+        """Test if the parallel processing of a region above the cell
+        threshold gives the same result as the serial processing
+        """
+        if mp.cpu_count() < 2:
+            self.skipTest("At least 2 CPUs are needed")
+        mapcalc_params = [
+            param["name"] for param in command_info("r.mapcalc")["params"]
+        ]
+        if "nprocs" not in mapcalc_params and not grass.find_program(
+            "r.mapcalc.tiled", "--help"
+        ):
+            self.skipTest("r.mapcalc has no nprocs, r.mapcalc.tiled missing")
+        # refine the region to more cells than the threshold, so the
+        # parallel processing is actually used
+        region = grass.region()
+        factor = 1 + math.ceil(
+            math.sqrt(
+                self.min_parallel_cells / (region["rows"] * region["cols"])
+            )
+        )
+        grass.run_command(
+            "g.region",
+            nsres=region["nsres"] / factor,
+            ewres=region["ewres"] / factor,
+        )
+        try:
+            region = grass.region()
+            self.assertGreaterEqual(
+                region["rows"] * region["cols"], self.min_parallel_cells
+            )
+            self.create_references()
+            par_kwargs = {
+                "blue": self.blue,
+                "green": self.green,
+                "red": self.red,
+                "nir": self.nir,
+                "index": "NDVI,asm",
+            }
+            par_index = SimpleModule(
+                "i.sentinel_2.parallel.index",
+                output=f"{self.ndvi},{self.asm}",
+                nprocs=2,
+                **par_kwargs,
+            )
+            self.assertModule(par_index)
+            par_index = SimpleModule(
+                "i.sentinel_2.parallel.index",
+                output=f"{self.ndvi_serial},{self.asm_serial}",
+                nprocs=1,
+                **par_kwargs,
+            )
+            self.assertModule(par_index)
+            self.assertRastersNoDifference(
+                self.ndvi, self.ndvi_serial, precision=0.0
+            )
+            self.assertRastersNoDifference(
+                self.ndvi, self.ndvi_ref, precision=1
+            )
+            self.assertRastersNoDifference(
+                self.asm, self.asm_serial, precision=0.0
+            )
+        finally:
+            grass.run_command("g.region", raster=self.blue)
+            self.create_references()
+
+
+if __name__ == "__main__":
+    test()
@@ -34,11 +34,18 @@
 # %End
 
 # %option G_OPT_F_INPUT
-# % required: yes
+# % required: no
 # % key: input_file
 # % label: Path to Sentinel-2 L1C dataset in .SAFE format
 # %end
 
+# %option G_OPT_M_DIR
+# % required: no
+# % key: input_dir
+# % label: Directory with Sentinel-2 L1C datasets in .SAFE format
+# % description: All scenes in the directory are processed in parallel
+# %end
+
 # %option
 # % required: yes
 # % key: output_dir
@@ -92,7 +99,14 @@
 # % description: Remove input folder after successful completion
 # %end
 
+# %rules
+# % required: input_file,input_dir
+# % exclusive: input_file,input_dir
+# %end
+
 import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import os
 from pathlib import Path
 import shutil
@@ -108,13 +122,19 @@ REL_DEM_DIR = None
 SEN2COR_DIR = None
 
 
-def cleanup():
-    """Cleanup files in the end"""
-    for rmfile in rm_files:
-        try:
-            os.remove(rmfile)
-        except OSError as ex:
-            grass.warning(_(f"Unable to remove file {rmfile}: {ex}"))
+def remove_folder(rmfolder):
+    """Removes a folder with all its content, warns if not possible"""
+    try:
+        shutil.rmtree(rmfolder)
+    except OSError as ex:
+        grass.warning(_(f"Unable to remove folder {rmfolder}: {ex}"))
+
+
+def remove_folders(max_workers=1):
+    """Removes the folders to remove and the DEM folders, with several
+    threads if max_workers > 1
+    """
+    global REL_DEM_DIR
     # remove DEM
     # find dem_folder, it can be in different folders depending on version.
     # for whatever reason it can also be in the home directory rather than
@@ -124,23 +144,134 @@ def cleanup():
         os.path.join(str(Path.home()), "sen2cor"),
         os.path.join("root", "sen2cor"),
     ]
-    possible_dirs = list(set(possible_dirs_all))
+    # drop duplicates, but keep the search order
+    possible_dirs = list(dict.fromkeys(possible_dirs_all))
     for possible_dir in possible_dirs:
-        for root, _dirname, _files in os.walk(possible_dir):
-            if REL_DEM_DIR in root:
-                rm_folders.append(root)
-    for rmfolder in rm_folders:
+        if not REL_DEM_DIR:
+            break
+        for root, dirnames, _files in os.walk(possible_dir):
+            # one DEM folder per scene if several scenes are processed
+            dem_dirs = [
+                dirname
+                for dirname in dirnames
+                if dirname == REL_DEM_DIR
+                or dirname.startswith(f"{REL_DEM_DIR}_")
+            ]
+            for dem_dir in dem_dirs:
+                rm_folders.append(os.path.join(root, dem_dir))
+                # no need to search inside the DEM folder
+                dirnames.remove(dem_dir)
+    # the DEM folders are found, no need to search again
+    REL_DEM_DIR = None
+    if max_workers > 1 and len(rm_folders) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(remove_folder, rm_folders))
+    else:
+        for rmfolder in rm_folders:
+            remove_folder(rmfolder)
+    rm_folders.clear()
+
+
+def cleanup():
+    """Cleanup files in the end"""
+    for rmfile in rm_files:
         try:
-            shutil.rmtree(rmfolder)
+            os.remove(rmfile)
         except OSError as ex:
-            grass.warning(_(f"Unable to remove folder {rmfolder}: {ex}"))
+            grass.warning(_(f"Unable to remove file {rmfile}: {ex}"))
+    # the folders are removed in parallel at the end of main(), this only
+    # removes what is left if the module failed before. No thread pool
+    # here: cleanup runs as atexit handler, when no new futures can be
+    # scheduled anymore
+    remove_folders()
+
+
+def write_gipp(gipp_path, nprocs, rel_dem_dir):
+    """Writes a copy of L2A_GIPP.xml modified according to user input"""
+    gipp_modified = grass.tempfile()
+    rm_files.append(gipp_modified)
+    tree = ET.parse(gipp_path)
+    root = tree.getroot()
+    # DEM list: https://github.com/senbox-org/snap-engine/blob/c92e2506eb57d56f6c7d3e739822f73c8186524c/etc/snap.auxdata.properties#L28
+    # - CGIAR-SRTM-1sec = ~90m resolution (0:00:03 deg):
+    update_dict = {
+        "Nr_Threads": str(nprocs),
+        "DEM_Directory": f"dem/{rel_dem_dir}",
+        "DEM_Reference": (
+            "https://srtm.csi.cgiar.org/wp-content"
+            "/uploads/files/srtm_5x5/TIFF/"
+        ),
+        "Aerosol_Type": options["aerosol_type"].upper(),
+        "Mid_Latitude": options["season"].upper(),
+        "Ozone_Content": options["ozone_content"],
+        "WV_Correction": "1",
+        "VIS_Update_Mode": "1",
+        "WV_Watermask": "1",
+        "Cirrus_Correction": "TRUE",
+        "DEM_Terrain_Correction": "TRUE",
+        # BRDF Correction is buggy in sen2cor, hence deactivated
+        "BRDF_Correction": "0",
+        "Downsample_20_to_60": "FALSE",
+    }
+    # update all elements in a single pass over the tree
+    for elem in root.iter():
+        if elem.tag in update_dict:
+            elem.text = update_dict[elem.tag]
+    tree.write(gipp_modified, encoding="utf-8", xml_declaration=True)
+    return gipp_modified
+
+
+def run_sen2cor(l2a_process, gipp_modified, input_file, output_dir):
+    """Runs sen2cor on a single scene, returns if it was successful and the
+    last lines of the sen2cor log
+    """
+    # build sen2cor command
+    cmd = [
+        l2a_process,
+        "--GIP_L2A",
+        gipp_modified,
+        "--output_dir",
+        output_dir,
+        input_file,
+    ]
+    grass.message(_(f"Running sen2cor using command:\n{' '.join(cmd)}\n..."))
+    # the log of sen2cor is streamed instead of buffered completely, only
+    # the last lines are kept for the error message
+    try:
+        sen2cor_cmd = grass.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+        )
+    except OSError as ex:
+        grass.fatal(_(f"Sen2Cor is not installed properly: {ex}"))
+    sen2cor_log = deque(maxlen=100)
+    successful = False
+    for line in sen2cor_cmd.stdout:
+        grass.verbose(line.rstrip())
+        sen2cor_log.append(line)
+        if "terminated successfully" in line:
+            successful = True
+    sen2cor_cmd.wait()
+    return successful, "".join(sen2cor_log)
+
+
+def scene_key(name):
+    """Returns datatake sensing time, relative orbit and tile of a Sentinel-2
+    product name, which are the same for the L1C input and the L2A output.
+    Tiles of the same datatake only differ in the tile part.
+    """
+    name_parts = name.split("_")
+    if len(name_parts) < 6:
+        return None
+    return (name_parts[2], name_parts[4], name_parts[5])
 
 
 def main():
     """Run i.sentinel_2.sen2cor"""
     global rm_files, rm_folders, REL_DEM_DIR, SEN2COR_DIR
     SEN2COR_DIR = options["sen2cor_path"]
-    input_file = options["input_file"]
     output_dir = options["output_dir"]
     nprocs = int(options["nprocs"])
 
@@ -149,114 +280,122 @@ def main():
 
     # test if sen2cor is installed properly
     l2a_process = os.path.join(SEN2COR_DIR, "bin", "L2A_Process")
-    cmd = grass.Popen(
-        f"{l2a_process} --help",
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
+    if not os.access(l2a_process, os.X_OK):
+        grass.fatal(
+            _(
+                "Sen2Cor is not installed properly: "
+                f"{l2a_process} is not executable."
+            )
+        )
+    try:
+        cmd = grass.Popen(
+            [l2a_process, "--help"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+    except OSError as ex:
+        grass.fatal(_(f"Sen2Cor is not installed properly: {ex}"))
     resp = cmd.communicate()
     if resp[1] != b"":
         grass.fatal(_("Sen2Cor is not installed properly."))
 
-    # test nprocs settings
-    if nprocs > mp.cpu_count():
+    # test nprocs settings, only count the CPUs this process may run on
+    # (e.g. limited by taskset or a container)
+    if hasattr(os, "sched_getaffinity"):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = mp.cpu_count()
+    if nprocs > cpu_count:
         grass.fatal(
             f"Using {nprocs} parallel processes but only "
-            f"{mp.cpu_count()} CPUs available."
+            f"{cpu_count} CPUs available."
         )
     elif nprocs == -2:
-        nprocs = mp.cpu_count() - 1
+        nprocs = max(1, cpu_count - 1)
+    elif nprocs < 1:
+        grass.fatal(_(f"Invalid number of parallel processes: {nprocs}"))
 
     # test input data
-    if not os.path.isdir(input_file):
-        grass.fatal(_(f"Input file {input_file} not found"))
-    elif not input_file.endswith(".SAFE"):
-        grass.fatal(_("Input file is not in .SAFE format"))
+    if options["input_dir"]:
+        if not os.path.isdir(options["input_dir"]):
+            grass.fatal(_(f"Directory {options['input_dir']} not found"))
+        input_files = sorted(
+            str(path) for path in Path(options["input_dir"]).glob("*.SAFE")
+        )
+        if not input_files:
+            grass.fatal(_(f"No .SAFE files found in {options['input_dir']}"))
+    else:
+        input_files = [options["input_file"]]
+    for input_file in input_files:
+        if not os.path.isdir(input_file):
+            grass.fatal(_(f"Input file {input_file} not found"))
+        elif not input_file.endswith(".SAFE"):
+            grass.fatal(_("Input file is not in .SAFE format"))
 
     # find L2A_GIPP.xml, it can be in different folders depending on version
-    for root, _dirname, files in os.walk(SEN2COR_DIR):
-        if "L2A_GIPP.xml" in files:
-            gipp_path = os.path.join(root, "L2A_GIPP.xml")
+    gipp_path = next(Path(SEN2COR_DIR).rglob("L2A_GIPP.xml"), None)
 
     if not gipp_path:
         grass.fatal(_(f"Could not find L2A_GIPP.xml in {SEN2COR_DIR}"))
 
-    # modify L2A_GIPP.xml according to user input
-    gipp_modified = grass.tempfile()
-    rm_files.append(gipp_modified)
-    tree = ET.parse(gipp_path)
-    root = tree.getroot()
+    # the scenes are processed in parallel and share the processes, each
+    # with its own GIPP and DEM folder
     REL_DEM_DIR = f"srtm_{os.getpid()}"
-    # DEM list: https://github.com/senbox-org/snap-engine/blob/c92e2506eb57d56f6c7d3e739822f73c8186524c/etc/snap.auxdata.properties#L28
-    # - CGIAR-SRTM-1sec = ~90m resolution (0:00:03 deg):
-    update_dict = {
-        "Nr_Threads": options["nprocs"],
-        "DEM_Directory": f"dem/{REL_DEM_DIR}",
-        "DEM_Reference": (
-            "https://srtm.csi.cgiar.org/wp-content"
-            "/uploads/files/srtm_5x5/TIFF/"
-        ),
-        "Aerosol_Type": options["aerosol_type"].upper(),
-        "Mid_Latitude": options["season"].upper(),
-        "Ozone_Content": options["ozone_content"],
-        "WV_Correction": "1",
-        "VIS_Update_Mode": "1",
-        "WV_Watermask": "1",
-        "Cirrus_Correction": "TRUE",
-        "DEM_Terrain_Correction": "TRUE",
-        # BRDF Correction is buggy in sen2cor, hence deactivated
-        "BRDF_Correction": "0",
-        "Downsample_20_to_60": "FALSE",
-    }
-    for item in update_dict.items():
-        for elem in root.iter(item[0]):
-            elem.text = item[1]
-    tree._setroot(root)
-    tree.write(gipp_modified, encoding="utf-8", xml_declaration=True)
-
-    # build sen2cor command
-    cmd_str = (
-        f"{l2a_process} --GIP_L2A {gipp_modified} "
-        f"--output_dir {output_dir} {input_file}"
-    )
-    sen2cor_cmd = grass.Popen(
-        cmd_str, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    grass.message(_(f"Running sen2cor using command:\n{cmd_str}\n..."))
-    sen2cor_resp = sen2cor_cmd.communicate()
-    successful = False
-    if "terminated successfully" in sen2cor_resp[0].decode("utf-8"):
-        successful = True
+    nr_parallel = min(nprocs, len(input_files))
+    gipp_files = []
+    for num in range(len(input_files)):
+        rel_dem_dir = (
+            REL_DEM_DIR if len(input_files) == 1 else f"{REL_DEM_DIR}_{num}"
+        )
+        gipp_files.append(
+            write_gipp(gipp_path, max(1, nprocs // nr_parallel), rel_dem_dir)
+        )
+    with ThreadPoolExecutor(max_workers=nr_parallel) as executor:
+        results = list(
+            executor.map(
+                run_sen2cor,
+                [l2a_process] * len(input_files),
+                gipp_files,
+                input_files,
+                [output_dir] * len(input_files),
+            )
+        )
 
-    input_file_dateblock = os.path.basename(input_file).split("_")[2]
-    # name of output file is not known before
-    for file in os.listdir(output_dir):
-        try:
-            output_file_dateblock = file.split("_")[2]
-            if output_file_dateblock == input_file_dateblock:
-                if successful is True:
-                    grass.message(
-                        _(
-                            "Atmospherical Correction complete, generated "
-                            f"output file <{os.path.join(output_dir, file)}>"
-                        )
+    # name of output file is not known before, so the output files are
+    # grouped by their scene in a single directory scan
+    output_files = {}
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            scene = scene_key(entry.name)
+            if scene:
+                output_files.setdefault(scene, []).append(entry.path)
+    errors = []
+    for input_file, (successful, sen2cor_log) in zip(input_files, results):
+        input_scene = scene_key(os.path.basename(input_file))
+        for output_file in output_files.get(input_scene, []):
+            if successful is True:
+                grass.message(
+                    _(
+                        "Atmospherical Correction complete, generated "
+                        f"output file <{output_file}>"
                     )
+                )
+            else:
+                # remove result if not successful
+                rm_folders.append(output_file)
 
-                else:
-                    # remove result if not successful
-                    rm_folders.append(os.path.join(output_dir, file))
-        except Exception:
-            pass
+        if successful is False:
+            errors.append(sen2cor_log)
+        elif flags["r"]:
+            rm_folders.append(input_file)
 
-    if successful is False:
-        error_msg = ""
-        for sen2cor_r in sen2cor_resp:
-            error_msg += sen2cor_r.decode("utf-8")
-        grass.fatal(_(f"Error using sen2cor: {error_msg}"))
+    # the folders (L2A results, input scenes, DEM) can hold thousands of
+    # files, removing them is IO-bound and is done in parallel
+    remove_folders(max_workers=16)
 
-    if flags["r"]:
-        rm_folders.append(input_file)
+    if errors:
+        error_msg = "\n".join(errors)
+        grass.fatal(_(f"Error using sen2cor: {error_msg}"))
 
 
 if __name__ == "__main__":